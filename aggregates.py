@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Materialized per-driver, per-series and per-track statistics.
+
+    The driver_week_stats, series_class_stats and track_car_stats tables hold
+    running totals. update_aggregates folds newly stored subsessions into them
+    with one grouped upsert per table, so keeping them current costs in
+    proportion to the new results rather than to the whole event_result
+    table. Averages and rates are derived from the totals when read. The
+    series_result rows of each race (field size and strength of field per
+    class) and the rating_history rows of each driver (iRating and license
+    before and after the race, by car category) are derived in the same
+    pass. aggregated_subsessions records
+    what has been folded in, so a subsession is never counted twice.
+"""
+
+from db_models import (db, CollectedSubsession, DriverWeekStats, SeriesClassStats, TrackCarStats, AggregatedSubsession,
+                       SeriesResult, RatingHistory)
+
+CHUNK = 500
+
+# one row per subsession, the season, week and track are the same for every class in it.
+# CROSS JOIN keeps the batch as the outer loop, so only its own events are looked at.
+BATCH_EVENTS = '''
+    SELECT e.subsessionid, MIN(e.seasonid) AS seasonid, MIN(e.race_week_num) AS race_week_num, MIN(e.trackid) AS trackid,
+           MIN(e.sessionid) AS sessionid, MIN(e.raw_start_time) AS raw_start_time, MIN(e.officialsession) AS officialsession,
+           MIN(e.catid) AS catid
+    FROM temp.aggregate_batch b CROSS JOIN events e ON e.subsessionid = b.subsessionid
+    GROUP BY e.subsessionid'''
+
+# the + stops SQLite using the carclassid index, which spans every race of the class,
+# instead of the primary key, which only spans this subsession
+BATCH_RESULTS = '''
+    SELECT r.*, e.seasonid, e.race_week_num, e.trackid, e.sessionid, e.raw_start_time, e.officialsession, e.catid,
+           r.finpos = (SELECT MIN(w.finpos) FROM event_result w
+                       WHERE w.subsessionid = r.subsessionid AND +w.carclassid = r.carclassid) AS won,
+           CASE WHEN r.oldirating > 0 AND r.newirating > 0 THEN r.newirating - r.oldirating ELSE 0 END AS irating_delta
+    FROM event_result r JOIN ({}) e ON e.subsessionid = r.subsessionid'''.format(BATCH_EVENTS)
+
+# MIN() in SQLite also returns the other bare columns from the row holding the minimum
+UPSERTS = [
+    '''INSERT INTO driver_week_stats
+           (custid, seasonid, race_week_num, starts, wins, finpos_sum, incidents, laps, points, irating_delta, best_lap)
+       SELECT custid, seasonid, race_week_num, COUNT(*), SUM(won), SUM(finpos), SUM(inc), SUM(lapscomp), SUM(pts),
+              SUM(irating_delta), MIN(fastestlaptime)
+       FROM ({}) GROUP BY custid, seasonid, race_week_num
+       ON CONFLICT (custid, seasonid, race_week_num) DO UPDATE SET
+           starts = starts + excluded.starts,
+           wins = wins + excluded.wins,
+           finpos_sum = finpos_sum + excluded.finpos_sum,
+           incidents = incidents + excluded.incidents,
+           laps = laps + excluded.laps,
+           points = points + excluded.points,
+           irating_delta = irating_delta + excluded.irating_delta,
+           best_lap = MIN(COALESCE(best_lap, excluded.best_lap), COALESCE(excluded.best_lap, best_lap))''',
+    '''INSERT INTO series_class_stats
+           (seasonid, carclassid, races, starts, incidents, laps, irating_delta, best_lap, best_lap_custid)
+       SELECT seasonid, carclassid, COUNT(DISTINCT subsessionid), COUNT(*), SUM(inc), SUM(lapscomp),
+              SUM(irating_delta), MIN(fastestlaptime), custid
+       FROM ({}) GROUP BY seasonid, carclassid
+       ON CONFLICT (seasonid, carclassid) DO UPDATE SET
+           races = races + excluded.races,
+           starts = starts + excluded.starts,
+           incidents = incidents + excluded.incidents,
+           laps = laps + excluded.laps,
+           irating_delta = irating_delta + excluded.irating_delta,
+           best_lap_custid = CASE WHEN best_lap IS NULL OR excluded.best_lap < best_lap
+                                  THEN excluded.best_lap_custid ELSE best_lap_custid END,
+           best_lap = MIN(COALESCE(best_lap, excluded.best_lap), COALESCE(excluded.best_lap, best_lap))''',
+    '''INSERT INTO track_car_stats
+           (trackid, carid, races, starts, incidents, laps, avg_lap_sum, avg_lap_count, best_lap, best_lap_custid,
+            best_lap_subsessionid)
+       SELECT trackid, carid, COUNT(DISTINCT subsessionid), COUNT(*), SUM(inc), SUM(lapscomp),
+              TOTAL(averagelaptime), COUNT(averagelaptime), MIN(fastestlaptime), custid, subsessionid
+       FROM ({}) GROUP BY trackid, carid
+       ON CONFLICT (trackid, carid) DO UPDATE SET
+           races = races + excluded.races,
+           starts = starts + excluded.starts,
+           incidents = incidents + excluded.incidents,
+           laps = laps + excluded.laps,
+           avg_lap_sum = avg_lap_sum + excluded.avg_lap_sum,
+           avg_lap_count = avg_lap_count + excluded.avg_lap_count,
+           best_lap_custid = CASE WHEN best_lap IS NULL OR excluded.best_lap < best_lap
+                                  THEN excluded.best_lap_custid ELSE best_lap_custid END,
+           best_lap_subsessionid = CASE WHEN best_lap IS NULL OR excluded.best_lap < best_lap
+                                        THEN excluded.best_lap_subsessionid ELSE best_lap_subsessionid END,
+           best_lap = MIN(COALESCE(best_lap, excluded.best_lap), COALESCE(excluded.best_lap, best_lap))''',
+]
+
+# one row per class of each race, sof() is db_models.StrengthOfField
+SERIES_RESULTS = '''
+    INSERT INTO series_result
+        (seasonid, week_num, start_time, carclassid, trackid, sessionid, subsessionid, officialsession,
+         sizeoffield, strengthoffield)
+    SELECT seasonid, race_week_num, raw_start_time, carclassid, trackid, sessionid, subsessionid, officialsession,
+           COUNT(*), COALESCE(sof(oldirating), 0)
+    FROM ({}) GROUP BY subsessionid, carclassid
+    ON CONFLICT (subsessionid, carclassid) DO UPDATE SET
+        sizeoffield = excluded.sizeoffield,
+        strengthoffield = excluded.strengthoffield'''
+
+
+# one row per driver and race, keyed by when it started so a driver's history reads in order
+RATING_HISTORY = '''
+    INSERT INTO rating_history
+        (custid, carcategory, raw_start_time, subsessionid, oldirating, newirating,
+         oldlicenselevel, oldlicensesublevel, newlicenselevel, newlicensesublevel)
+    SELECT custid, catid, raw_start_time, subsessionid, oldirating, newirating,
+           oldlicenselevel, oldlicensesublevel, newlicenselevel, newlicensesublevel
+    FROM ({}) WHERE catid IS NOT NULL AND raw_start_time IS NOT NULL
+    ON CONFLICT (custid, carcategory, raw_start_time) DO UPDATE SET
+        subsessionid = excluded.subsessionid,
+        oldirating = excluded.oldirating,
+        newirating = excluded.newirating,
+        oldlicenselevel = excluded.oldlicenselevel,
+        oldlicensesublevel = excluded.oldlicensesublevel,
+        newlicenselevel = excluded.newlicenselevel,
+        newlicensesublevel = excluded.newlicensesublevel'''
+
+
+def _fold(subsessionids, statements, skip_aggregated=True):
+    """ Run `statements` over the results of `subsessionids`, a chunk at a time """
+    db.execute_sql('CREATE TEMP TABLE IF NOT EXISTS aggregate_batch (subsessionid INTEGER PRIMARY KEY)')
+    for i in range(0, len(subsessionids), CHUNK):
+        chunk = [(int(s),) for s in subsessionids[i:i + CHUNK]]
+        db.execute_sql('DELETE FROM temp.aggregate_batch')
+        db.cursor().executemany('INSERT OR IGNORE INTO temp.aggregate_batch VALUES (?)', chunk)
+        if skip_aggregated:
+            db.execute_sql('DELETE FROM temp.aggregate_batch WHERE subsessionid IN '
+                           '(SELECT subsessionid FROM aggregated_subsessions)')
+        for sql in statements:
+            db.execute_sql(sql.format(BATCH_RESULTS))
+        if skip_aggregated:
+            db.execute_sql('INSERT INTO aggregated_subsessions SELECT subsessionid FROM temp.aggregate_batch')
+    db.execute_sql('DELETE FROM temp.aggregate_batch')
+
+
+def update_aggregates(subsessionids):
+    """ Fold the stored results of `subsessionids` into the aggregate tables
+        and derive their series_result and rating_history rows, skipping any that were folded
+        in before. Meant to run in the same transaction that stores the
+        results, see WriteBuffer.defer_batch.
+    """
+    with db.atomic():
+        _fold(subsessionids, UPSERTS + [SERIES_RESULTS, RATING_HISTORY])
+
+
+def collected_subsessionids():
+    return [s for s, in CollectedSubsession.select(CollectedSubsession.subsessionid).tuples()]
+
+
+def rebuild_aggregates():
+    """ Recompute the aggregate tables, series_result and rating_history from every collected subsession """
+    with db.atomic():
+        for model in (DriverWeekStats, SeriesClassStats, TrackCarStats, SeriesResult, RatingHistory,
+                      AggregatedSubsession):
+            model.delete().execute()
+        update_aggregates(collected_subsessionids())
+
+
+def rebuild_totals():
+    """ Recompute driver_week_stats, series_class_stats and track_car_stats alone """
+    with db.atomic():
+        for model in (DriverWeekStats, SeriesClassStats, TrackCarStats, AggregatedSubsession):
+            model.delete().execute()
+        _fold(collected_subsessionids(), UPSERTS)
+
+
+def rebuild_series_results():
+    """ Derive series_result alone from every collected subsession """
+    with db.atomic():
+        SeriesResult.delete().execute()
+        _fold(collected_subsessionids(), [SERIES_RESULTS], skip_aggregated=False)
+
+
+def rebuild_rating_history():
+    """ Derive rating_history alone from every collected subsession """
+    with db.atomic():
+        RatingHistory.delete().execute()
+        _fold(collected_subsessionids(), [RATING_HISTORY], skip_aggregated=False)
+
+
+def driver_week(custid, seasonid, race_week_num):
+    """ A driver's totals for one week of a season, or None if they didn't race """
+    return DriverWeekStats.get_or_none(custid=custid, seasonid=seasonid, race_week_num=race_week_num)
+
+
+def driver_season(custid, seasonid):
+    """ A driver's totals for each week of a season they raced in """
+    return list(DriverWeekStats
+                .select()
+                .where((DriverWeekStats.custid == custid) & (DriverWeekStats.seasonid == seasonid))
+                .order_by(DriverWeekStats.race_week_num))
+
+
+def series_class(seasonid, carclassid):
+    return SeriesClassStats.get_or_none(seasonid=seasonid, carclassid=carclassid)
+
+
+def track_car(trackid, carid):
+    return TrackCarStats.get_or_none(trackid=trackid, carid=carid)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Microbenchmark of the lap time parsers against the strptime approach
+    collect.py used before laptimes.py existed.
+
+    python benchmarks/bench_laptimes.py [-n VALUES] [-r REPEATS]
+"""
+
+import os
+import sys
+import random
+import argparse
+import datetime
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from laptimes import np, parse_laptime, parse_laptimes, laptime_array
+
+
+def strptime_laptime(value):
+    """ The original per-value conversion from Worker.collect_results """
+    if value == "00.000":
+        value = None
+    if value:
+        if value.find(":") > -1:
+            t = datetime.datetime.strptime(value, "%M:%S.%f")
+            value = (t.minute * 60) + t.second + (t.microsecond / 1000000)
+        else:
+            value = float(value)
+    return value
+
+
+def sample_values(count, seed=1):
+    """ A column of lap times shaped like a real results page """
+    rnd = random.Random(seed)
+    values = []
+    for _ in range(count):
+        roll = rnd.random()
+        if roll < 0.1:
+            values.append("00.000")
+        elif roll < 0.3:
+            millis = rnd.randrange(40000, 60000)
+            values.append("{}.{:03d}".format(millis // 1000, millis % 1000))
+        else:
+            millis = rnd.randrange(60000, 240000)
+            values.append("{}:{:02d}.{:03d}".format(millis // 60000, millis // 1000 % 60, millis % 1000))
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--values", type=int, default=100000)
+    parser.add_argument("-r", "--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    values = sample_values(args.values)
+
+    # all parsers have to agree before their speed means anything
+    expected = [strptime_laptime(v) for v in values]
+    for name, got in (("parse_laptime", [parse_laptime(v) for v in values]), ("parse_laptimes", parse_laptimes(values))):
+        for a, b in zip(expected, got):
+            assert (a is None and b is None) or abs(a - b) < 1e-9, (name, a, b)
+
+    cases = [
+        ("strptime (old)", lambda: [strptime_laptime(v) for v in values]),
+        ("parse_laptime", lambda: [parse_laptime(v) for v in values]),
+        ("parse_laptimes", lambda: parse_laptimes(values)),
+    ]
+    if np is not None:
+        cases.append(("laptime_array", lambda: laptime_array(values)))
+
+    print("{} lap times, best of {}".format(len(values), args.repeats))
+    baseline = None
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeats))
+        baseline = baseline or best
+        print("{:<16} {:8.1f} ms {:12,.0f} values/s {:6.1f}x".format(name, best * 1000, len(values) / best, baseline / best))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Check that the collection pipeline runs in constant memory.
+
+    python benchmarks/bench_memory.py [--sizes N N ...] [--tolerance FRACTION]
+
+    Collects a synthetic season of each size (in subsessions) with
+    Worker.collect, each in a fresh process and database, and measures the
+    peak of the memory Python allocated while doing so with tracemalloc.
+    Exits with status 1 if the peak of the largest run is more than
+    `tolerance` above that of the smallest, i.e. if memory grows with the
+    number of subsessions. tests/test_memory.py runs the same comparison
+    on two small sizes.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+YEAR, QUARTER = 2019, 2
+
+# allowed growth of the peak from the smallest run to the largest
+TOLERANCE = 0.25
+
+
+def measure(subsessions, min_drivers, max_drivers):
+    """ Peak traced memory in MB of collecting `subsessions` races, in this process """
+    import collect
+    from db_models import init_db, db, EventResult
+    from job_queue import ARCHIVE_PAGE, archive_page_key
+    from crawl import season_key
+    from synthetic import SyntheticWebStats
+    from bench_pipeline import BenchApp
+
+    workdir = tempfile.mkdtemp(prefix='bench-memory-')
+    try:
+        init_db(os.path.join(workdir, 'bench.sqlite3'))
+        irw = SyntheticWebStats(subsessions=subsessions, min_drivers=min_drivers, max_drivers=max_drivers)
+        args = collect.parse_args(['bench', '--no-cache', '--rate-limit', '0'])
+        worker = collect.Worker(BenchApp(args, irw))
+        season = season_key(YEAR, QUARTER, 'road')
+        worker.jobs.add(ARCHIVE_PAGE, [archive_page_key(season, 1)])
+
+        tracemalloc.start()
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            worker.collect()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {'subsessions': subsessions, 'results': EventResult.select().count(), 'peak_mb': round(peak / 1048576.0, 2)}
+    finally:
+        db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(size, min_drivers, max_drivers):
+    """ measure() in a fresh process, so each run starts from the same memory """
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', str(size),
+                                      '--min-drivers', str(min_drivers), '--max-drivers', str(max_drivers)])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def growth(runs):
+    """ How much higher the peak of the largest run is than that of the smallest, as a fraction """
+    return runs[-1]['peak_mb'] / runs[0]['peak_mb'] - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 5000], help="subsessions to collect in each run")
+    parser.add_argument("--min-drivers", type=int, default=20)
+    parser.add_argument("--max-drivers", type=int, default=60)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed growth of the peak over the smallest run")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.min_drivers, args.max_drivers)))
+        return 0
+
+    runs = []
+    for size in sorted(args.sizes):
+        runs.append(run(size, args.min_drivers, args.max_drivers))
+        print("{subsessions:>10} subsessions {results:>10} results {peak_mb:>10} MB peak".format(**runs[-1]))
+
+    grown = growth(runs)
+    print("Peak memory grew {:.0%} from {} to {} subsessions".format(grown, runs[0]['subsessions'], runs[-1]['subsessions']))
+    if grown > args.tolerance:
+        print("FAIL: more than the {:.0%} allowed".format(args.tolerance))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
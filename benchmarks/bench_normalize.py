@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Throughput of result normalization against the number of processes.
+
+    python benchmarks/bench_normalize.py [-n SUBSESSIONS] [--workers N N ...] [--batch-size N]
+
+    Normalizes the same synthetic results payloads through NormalizePool
+    with each number of workers (1 runs inline, as collect.py does without
+    --workers) and reports result rows/s and the speedup over the run with
+    the fewest workers. On a machine with enough cores the speedup should
+    stay close to the number of workers; on a single core the pool only
+    adds the cost of shipping payloads between processes.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from normalize import NormalizePool
+from synthetic import SyntheticWebStats
+
+
+def payloads(irw, count):
+    base = SyntheticWebStats.season_base(2019, 2)
+    for subsessionid in range(base, base + count):
+        yield subsessionid, irw.results(subsessionid)[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--subsessions", type=int, default=20000)
+    parser.add_argument("--min-drivers", type=int, default=20)
+    parser.add_argument("--max-drivers", type=int, default=60)
+    parser.add_argument("--workers", type=int, nargs='+', default=None, help="process counts to try, defaults to powers of two up to the number of CPUs")
+    parser.add_argument("--batch-size", type=int, default=50, help="subsessions per task sent to a process")
+    args = parser.parse_args()
+
+    if not args.workers:
+        cpus = os.cpu_count() or 1
+        args.workers = [1] + [2 ** i for i in range(1, cpus.bit_length()) if 2 ** i <= cpus]
+
+    irw = SyntheticWebStats(subsessions=args.subsessions, min_drivers=args.min_drivers, max_drivers=args.max_drivers)
+    # generated up front so only the normalizing is timed
+    batch = list(payloads(irw, args.subsessions))
+
+    print("{:>8} {:>10} {:>10} {:>14} {:>9}".format('workers', 'rows', 'seconds', 'rows/s', 'speedup'))
+    inline = None
+    for workers in sorted(args.workers):
+        rows = 0
+        start = time.perf_counter()
+        with NormalizePool(workers=workers, batch_size=args.batch_size) as pool:
+            # the payloads are copied, the inline run converts lap times in place
+            for _, _, driver_rows, team_rows in pool.map((s, [dict(r) for r in results]) for s, results in batch):
+                rows += len(driver_rows) + len(team_rows)
+        elapsed = time.perf_counter() - start
+        rate = rows / elapsed
+        inline = inline or rate
+        print("{:>8} {:>10} {:>10.2f} {:>14.0f} {:>8.2f}x".format(workers, rows, elapsed, rate, rate / inline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
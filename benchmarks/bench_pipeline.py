@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" End to end benchmark of the collection pipeline on synthetic data.
+
+    python benchmarks/bench_pipeline.py [-n SUBSESSIONS] [--min-drivers N] [--max-drivers N] [-o FILE]
+
+    Runs each stage on its own against a fresh database in a temporary
+    directory: archive paging (through Worker.collect_archive), fetching the
+    results, lap time conversion, result parsing, the database insert and a
+    few typical stats queries. The insert stage stores the rows through
+    Worker.save_results, so it includes the update of the aggregate tables.
+    For every stage it reports rows/s, latency percentiles of the individual
+    operations and the peak RSS so far, and the report is saved as JSON so
+    runs on different commits can be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import collect
+import queries
+from db_models import init_db, db, Event, EventResult, DriverWeekStats, SeriesResult, RatingHistory
+from job_queue import ARCHIVE_PAGE, archive_page_key
+from crawl import season_key
+from laptimes import parse_laptimes
+from normalize import LAPTIME_FIELDS, result_rows
+from synthetic import SyntheticWebStats
+
+YEAR, QUARTER = 2019, 2
+QUERIES = ['driver_history', 'track_record', 'season_standings', 'rating_history', 'cached_lookup']
+# what the queries read, reported so a stage never times an empty table unnoticed
+TABLES = [EventResult, DriverWeekStats, SeriesResult, RatingHistory]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024.0
+    return rss / 1024.0
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Stage(object):
+    """ Timings of the individual operations of one pipeline stage """
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        self.rows = 0
+
+    @contextlib.contextmanager
+    def time(self, rows=0):
+        start = time.perf_counter()
+        yield
+        self.samples.append(time.perf_counter() - start)
+        self.rows += rows
+
+    def report(self):
+        ordered = sorted(self.samples)
+        total = sum(ordered)
+        ms = lambda value: None if value is None else round(value * 1000, 4)
+        return {
+            'operations': len(ordered),
+            'rows': self.rows,
+            'seconds': round(total, 4),
+            'rows_per_second': round(self.rows / total, 1) if total else None,
+            'p50_ms': ms(percentile(ordered, 0.5)),
+            'p95_ms': ms(percentile(ordered, 0.95)),
+            'p99_ms': ms(percentile(ordered, 0.99)),
+            'max_ms': ms(ordered[-1] if ordered else None),
+            # peak so far, the stages run one after another
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+
+
+class BenchApp(object):
+    """ Just enough of collect.App for a Worker """
+
+    def __init__(self, args, irw):
+        self.args = args
+        self.irw = irw
+        self.log = logging.getLogger('bench')
+
+
+def bench_archive(worker, stage):
+    fetch_page = worker.fetch_archive_page
+
+    def timed_fetch(key):
+        start = time.perf_counter()
+        try:
+            return fetch_page(key)
+        finally:
+            stage.samples.append(time.perf_counter() - start)
+
+    worker.fetch_archive_page = timed_fetch
+    season = season_key(YEAR, QUARTER, 'road')
+    worker.jobs.add(ARCHIVE_PAGE, [archive_page_key(season, 1)])
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        worker.collect_archive()
+    elapsed = time.perf_counter() - start
+    stage.rows = Event.select().count()
+    # the samples are the page fetches, the throughput is for the whole stage including the writes
+    report = stage.report()
+    report['seconds'] = round(elapsed, 4)
+    report['rows_per_second'] = round(stage.rows / elapsed, 1)
+    return report
+
+
+def bench_results(worker, irw, stages):
+    fetch, laptimes, parse, insert = stages
+    subsessionids = [s for s, in Event.select(Event.subsessionid).order_by(Event.subsessionid).tuples()]
+    for subsessionid in subsessionids:
+        with fetch.time(rows=1):
+            payload = irw.event_results(subsessionid)
+        results = payload[1]
+        with laptimes.time(rows=len(results) * len(LAPTIME_FIELDS)):
+            for name in LAPTIME_FIELDS:
+                parse_laptimes([result[name] for result in results])
+        with parse.time(rows=len(results)):
+            driver_rows, team_rows = result_rows(subsessionid, results)
+        # what collection does with them, folding into the aggregate tables included
+        with insert.time(rows=len(results)):
+            worker.save_results(subsessionid, len(results), driver_rows, team_rows)
+    with insert.time():
+        worker.writer.flush()
+
+
+def bench_queries(stages, repeats, seed=1):
+    rnd = random.Random(seed)
+    custids = [c for c, in EventResult.select(EventResult.custid).distinct().limit(5000).tuples()]
+    classes = list(Event.select(Event.seasonid, Event.carclassid).distinct().tuples())
+    tracks = list(Event.select(Event.trackid, Event.carid).distinct().tuples())
+    categories = [c for c, in Event.select(Event.catid).distinct().tuples()]
+
+    # the queries themselves, the cache gets its own stage
+    for _ in range(repeats):
+        with stages['driver_history'].time(rows=1):
+            queries.driver_history.uncached(rnd.choice(custids))
+        with stages['track_record'].time(rows=1):
+            queries.track_records.uncached(*rnd.choice(tracks))
+        with stages['rating_history'].time(rows=1):
+            queries.rating_history.uncached(rnd.choice(custids), rnd.choice(categories), interval='week')
+    for seasonid, carclassid in classes:
+        with stages['season_standings'].time(rows=1):
+            queries.season_standings.uncached(seasonid, carclassid)
+
+    # a web front end asking about the same popular drivers over and over
+    popular = custids[:50]
+    for _ in range(repeats * 10):
+        with stages['cached_lookup'].time(rows=1):
+            queries.driver_history(rnd.choice(popular))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--subsessions", type=int, default=50000)
+    parser.add_argument("--min-drivers", type=int, default=20)
+    parser.add_argument("--max-drivers", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=8, help="fetch workers for the archive stage")
+    parser.add_argument("--queries", type=int, default=200, help="repeats of each driver and track query")
+    parser.add_argument("-o", "--output", help="JSON report file, defaults to benchmarks/results/pipeline-<commit>.json")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    workdir = tempfile.mkdtemp(prefix='bench-pipeline-')
+    try:
+        init_db(os.path.join(workdir, 'bench.sqlite3'))
+        irw = SyntheticWebStats(subsessions=args.subsessions, min_drivers=args.min_drivers, max_drivers=args.max_drivers)
+        worker_args = collect.parse_args(['bench', '--no-cache', '--rate-limit', '0',
+                                          '--fetch-workers', str(args.workers)])
+        worker = collect.Worker(BenchApp(worker_args, irw))
+
+        stages = dict((name, Stage(name)) for name in ['archive', 'fetch', 'laptimes', 'parse', 'insert'] + QUERIES)
+        reports = {}
+        print("archive paging...")
+        reports['archive'] = bench_archive(worker, stages['archive'])
+
+        print("results: fetch, lap times, parsing and inserts...")
+        bench_results(worker, irw, [stages[name] for name in ['fetch', 'laptimes', 'parse', 'insert']])
+        for name in ['fetch', 'laptimes', 'parse', 'insert']:
+            reports[name] = stages[name].report()
+
+        table_rows = dict((model._meta.table_name, model.select().count()) for model in TABLES)
+        print("table rows: {}".format(", ".join("{} {}".format(*item) for item in table_rows.items())))
+
+        print("stats queries...")
+        bench_queries(stages, args.queries)
+        for name in QUERIES:
+            reports[name] = stages[name].report()
+
+        report = {
+            'benchmark': 'pipeline',
+            'commit': commit,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'params': vars(args),
+            'table_rows': table_rows,
+            'database_mb': round(os.path.getsize(os.path.join(workdir, 'bench.sqlite3')) / 1048576.0, 1),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'stages': reports,
+        }
+    finally:
+        db.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("{:<16} {:>10} {:>10} {:>14} {:>10} {:>10} {:>10} {:>9}".format(
+        'stage', 'rows', 'seconds', 'rows/s', 'p50 ms', 'p95 ms', 'p99 ms', 'rss MB'))
+    for name, stage in report['stages'].items():
+        print("{:<16} {:>10} {:>10} {:>14} {:>10} {:>10} {:>10} {:>9}".format(
+            name, stage['rows'], stage['seconds'], stage['rows_per_second'], stage['p50_ms'],
+            stage['p95_ms'], stage['p99_ms'], stage['peak_rss_mb']))
+
+    output = args.output or os.path.join(HERE, 'results', 'pipeline-{}.json'.format(commit or 'unknown'))
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Report saved to {}".format(output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
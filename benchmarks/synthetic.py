@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Synthetic stats site data at realistic scale, for the benchmarks.
+
+    SyntheticWebStats is a ReplayWebStats whose responses are generated
+    rather than read from disk: every season has `subsessions` races of
+    `min_drivers` to `max_drivers` drivers each. A subsession's payload only
+    depends on its id, so repeated runs see identical data.
+"""
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replay import ReplayWebStats
+from crawl import ARCHIVE_PAGE_SIZE
+
+CAR_CLASSES = [(74, 'Skip Barber', 12), (84, 'GT3', 45), (85, 'GTE', 46), (86, 'LMP2', 47)]
+OUT_REASONS = [(0, 'Running'), (32, 'Disconnected'), (45, 'Disqualified')]
+DRIVER_POOL = 50000
+
+
+def format_laptime(millis):
+    if millis >= 60000:
+        return "{}:{:02d}.{:03d}".format(millis // 60000, millis // 1000 % 60, millis % 1000)
+    return "{:02d}.{:03d}".format(millis // 1000, millis % 1000)
+
+
+class SyntheticWebStats(ReplayWebStats):
+
+    def __init__(self, subsessions=50000, min_drivers=20, max_drivers=60, **kwargs):
+        ReplayWebStats.__init__(self, directory='', **kwargs)
+        self.subsessions = subsessions
+        self.min_drivers = min_drivers
+        self.max_drivers = max_drivers
+        self.CARS = dict((carid, {'id': carid, 'abbrevname': 'C{}'.format(carid), 'name': 'Car {}'.format(carid),
+                                  'dirpath': 'car{}'.format(carid)}) for _, _, carid in CAR_CLASSES)
+        self.CARCLASS = dict((classid, {'id': classid, 'name': name, 'shortname': name})
+                             for classid, name, _ in CAR_CLASSES)
+        self.TRACKS = dict((trackid, {'id': trackid, 'name': 'Track {}'.format(trackid), 'config': '',
+                                      'lowerNameAndConfig': 'track {}'.format(trackid), 'catid': 2,
+                                      'freeWithSubscription': 'false'}) for trackid in range(1, 13))
+
+    @staticmethod
+    def season_base(year, quarter):
+        return (int(year) * 4 + int(quarter)) * 1000000
+
+    def load(self, method, args, kwargs):
+        if method == 'results_archive':
+            return self.archive_page(kwargs['season'], kwargs.get('page', 1))
+        return self.results(args[0])
+
+    def archive_page(self, season, page):
+        year, quarter = int(season[0]), int(season[1])
+        base = self.season_base(year, quarter)
+        first = (page - 1) * ARCHIVE_PAGE_SIZE
+        events = [self.event(base + i, year, quarter) for i in range(first, min(first + ARCHIVE_PAGE_SIZE, self.subsessions))]
+        return events, self.subsessions
+
+    def event(self, subsessionid, year, quarter):
+        rnd = random.Random(subsessionid)
+        carclassid, _, carid = rnd.choice(CAR_CLASSES)
+        week = subsessionid % 12
+        start = 1546300800000 + (subsessionid % 1000000) * 180000
+        return {
+            'subsessionid': subsessionid, 'sessionid': subsessionid // 3, 'evttype': 5,
+            'seasonid': 2000 + year % 100 * 4 + quarter, 'seriesid': carclassid, 'season_year': year,
+            'season_quarter': quarter, 'officialsession': 1, 'race_week_num': week,
+            'start_date': '2019-01-01', 'start_time': '10:00', 'raw_start_time': start, 'finishedat': start + 2700000,
+            'strengthoffield': rnd.randint(900, 4500), 'custid': rnd.randrange(DRIVER_POOL), 'displayname': 'Winner',
+            'carclassid': carclassid, 'carid': carid, 'trackid': week + 1, 'catid': 2, 'starting_position': 1,
+            'finishing_position': 1, 'incidents': 0, 'bestquallaptime': '1:23.456', 'bestlaptime': '1:22.345',
+            'champpoints': 100, 'clubpointssort': 1, 'helm_licenselevel': 20, 'helm_pattern': 1,
+            'helm_color1': 'ff0000', 'helm_color2': '00ff00', 'helm_color3': '0000ff', 'rn': 1, 'sesrank': 1,
+            'licensegroup': 4, 'clubpoints': 10, 'dropracepoints': 0, 'groupname': 'Class A',
+            'winnerdisplayname': 'Winner', 'winnerlicenselevel': 20, 'winnerhelmpattern': 1,
+            'winnerhelmcolor1': 'ff0000', 'winnerhelmcolor2': '00ff00', 'winnerhelmcolor3': '0000ff',
+            'winnersgroupid': 1, 'subsession_bestlaptime': '1:22.345', 'champpointssort': 100,
+        }
+
+    def results(self, subsessionid):
+        rnd = random.Random(subsessionid)
+        carclassid, carclass, carid = rnd.choice(CAR_CLASSES)
+        drivers = rnd.randint(self.min_drivers, self.max_drivers)
+        base_lap = rnd.randint(55000, 140000)
+        rows = []
+        for finpos, custid in enumerate(rnd.sample(range(1, DRIVER_POOL), drivers)):
+            outid, out = rnd.choice(OUT_REASONS) if rnd.random() < 0.1 else OUT_REASONS[0]
+            irating = rnd.randint(800, 5000)
+            rows.append({
+                'finpos': finpos, 'carid': carid, 'car': carid, 'carclassid': carclassid, 'carclass': carclass,
+                'teamid': -custid, 'custid': custid, 'name': 'Driver {}'.format(custid), 'startpos': rnd.randrange(drivers),
+                'outid': outid, 'out': out, 'interval': '-{}.{:03d}'.format(finpos * 2, rnd.randrange(1000)),
+                'lapsled': 0, 'qualifytime': format_laptime(base_lap + rnd.randrange(3000)) if rnd.random() < 0.8 else '00.000',
+                'averagelaptime': format_laptime(base_lap + rnd.randrange(5000, 9000)),
+                'fastestlaptime': format_laptime(base_lap + rnd.randrange(4000)), 'fastlap': rnd.randint(2, 20),
+                'lapscomp': 20, 'inc': rnd.choice([0, 0, 0, 1, 2, 4, 8]), 'pts': max(0, 100 - finpos * 3),
+                'clubpts': 1, 'div': 'Division {}'.format(rnd.randint(1, 10)), 'clubid': rnd.randint(1, 50),
+                'club': 'Club {}'.format(custid % 50), 'oldirating': irating, 'newirating': irating + rnd.randint(-80, 80),
+                'oldlicenselevel': 18, 'oldlicensesublevel': rnd.randint(100, 499), 'newlicenselevel': 18,
+                'newlicensesublevel': rnd.randint(100, 499), 'seriesname': 'Series {}'.format(carclassid),
+                'maxfuelfill': 100, 'weightpenaltykg': 0, 'aggpts': 0,
+            })
+        return {'subsessionid': subsessionid}, rows
@@ -46,245 +46,21 @@ __version__ = "v0.190428.1"
 import os
 import sys
 import argparse
-import datetime
 import logging, logging.handlers
-import threading
-import queue as queue
+import configobj
 
-from ir_webstats_rc import constants as ct
 from ir_webstats_rc.client import iRWebStats
-from ir_webstats_rc.util import clean
 
 from db_models import *
+from outbound import AdaptiveRateLimiter, ThrottledWebStats, pooled_session
+from response_cache import ResponseCache, CachedWebStats
+from replay import RecordingWebStats, ReplayWebStats
+from crawl import RACE_TYPES
+from metrics import metrics, MetricsExporter
+from worker import Worker, MyException
 
-lap_flags = {
-    0: "clean_laps",
-    2: "pitted",
-    4: "off_tracks",
-    8: "black_flags",
-    32: "contacts",
-    64: "car_contacts",
-    128: "lost_controls",
-    2048: "tows"
-}
-
-def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_length=70):
-    """Call in a loop to create terminal progress bar """
-    str_format = "{0:." + str(decimals) + "f}"
-    percents = str_format.format(100 * (iteration / float(total)))
-    filled_length = int(round(bar_length * iteration / float(total)))
-    bar = '█' * filled_length + '-' * (bar_length - filled_length)
-
-    sys.stdout.write('\r%s |%s| %s%s %s' % (prefix, bar, percents, '%', suffix)),
-
-    if iteration == total:
-        sys.stdout.write('\n')
-    sys.stdout.flush()
-
-def print_counting(count, prefix='', suffix='', finished=False):
-    """Call in a loop to create terminal count update """
-
-    sys.stdout.write('\r%s %s %s' % (prefix, count, suffix)),
-
-    if finished:
-        sys.stdout.write('\n')
-    sys.stdout.flush()
-
-class ExThread(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.__status_queue = queue.Queue()
-
-    def run_with_exception(self):
-        """This method should be overriden."""
-        raise NotImplementedError
-
-    def run(self):
-        """This method should NOT be overriden."""
-        try:
-            self.run_with_exception()
-        except BaseException:
-            self.__status_queue.put(sys.exc_info())
-        self.__status_queue.put(None)
-
-    def wait_for_exc_info(self):
-        return self.__status_queue.get()
-
-    def join_with_exception(self):
-        ex_info = self.wait_for_exc_info()
-        if ex_info is None:
-            return
-        else:
-            raise ex_info[1]
-
-
-class MyException(Exception):
-    pass
-
-
-class Worker(ExThread):
-    """ A class which contains the worker thread logic
-    """
-
-    def __init__(self, parent):
-        # copy over args from parent to self
-        self.args = parent.args
-
-        # copy over any other values from parent to self
-        self.irw = parent.irw
-
-        ExThread.__init__(self)
-
-    def collect_results(self, subsessionids):
-
-        print("Collecting results for {} races".format(len(subsessionids)))
-        print_progress(0, len(subsessionids), prefix="Progress: ", suffix="of results collected  ")
-        event_count = 0
-        result_count = 0
-        for subsessionid in subsessionids:
-            event_count += 1
-            good_session = False
-            race = EventResult.select().where(EventResult.subsessionid == subsessionid)
-            if not race.exists():
-                good_session = True
-            try:
-                event_results = self.irw.event_results(subsessionid)
-            except IndexError:
-                good_session = False
-            if good_session:
-                finposs = {}
-                results = event_results[1]
-                for result in results:
-                    if result['carclassid'] not in finposs.keys():
-                        finposs[result['carclassid']] = 1
-                    else:
-                        finposs[result['carclassid']] += 1
-                    result_count += 1
-
-                    for laptime_var in ['qualifytime', 'averagelaptime', 'fastestlaptime']:
-                        if result[laptime_var] == "00.000":
-                            result[laptime_var] = None
-                        if result[laptime_var]:
-                            if result[laptime_var].find(":") > -1:
-                                t = datetime.datetime.strptime(result[laptime_var], "%M:%S.%f")
-                                result[laptime_var] = (t.minute * 60) + t.second + (t.microsecond / 1000000)
-                            else:
-                                result[laptime_var] = float(result[laptime_var])
-
-                    result['subsessionid'] = subsessionid
-                    if int(result['custid']) < 0:
-                        Team.insert(id=result['teamid'], name=result['name']).on_conflict('REPLACE').execute()
-                    else:
-                        try:
-                            EventResult.insert(**result).on_conflict('IGNORE').execute()
-                        except:
-                            print(result)
-                    
-            print_progress(event_count, len(subsessionids), prefix="Progress: ", suffix="of results collected  ")
-
-        print("Race results for {} drivers saved to database".format(result_count))
-
-
-    def run_with_exception(self):
-        thread_name = threading.current_thread().name
-
-        if not self.irw.logged:
-            raise MyException("ERROR: {}".format("Login failed. Please check your credentials."))
-        else:
-            print("Updating service information...")
-            print("Updating Cars.")
-            cars = []
-            for car in self.irw.CARS:
-                query = Car.select().where(Car.carid == self.irw.CARS[car]['id'])
-                if not query.exists():
-                    cars.append({
-                        "carid": self.irw.CARS[car]['id'],
-                        "abbrevname": self.irw.CARS[car]['abbrevname'],
-                        "name": self.irw.CARS[car]['name'],
-                        "dirpath": self.irw.CARS[car]['dirpath'],
-                    })
-            if cars:
-                Car.insert_many(cars).execute()
-
-            print("Updating Car Classes.")
-            carclasses = []
-            for carclass in self.irw.CARCLASS:
-                query = CarClass.select().where(CarClass.carclassid == self.irw.CARCLASS[carclass]['id'])
-                if not query.exists():
-                    carclasses.append({
-                        "carclassid": self.irw.CARCLASS[carclass]['id'],
-                        "name": self.irw.CARCLASS[carclass]['name'],
-                        "shortname": self.irw.CARCLASS[carclass]['shortname'],
-                    })
-            if carclasses:
-                CarClass.insert_many(carclasses).execute()
-
-            print("Updating Tracks.")
-            tracks = []
-            for track in self.irw.TRACKS:
-                query = Track.select().where(Track.trackid == self.irw.TRACKS[track]['id'])
-                if not query.exists():
-                    tracks.append({
-                        "trackid": self.irw.TRACKS[track]['id'],
-                        "name": self.irw.TRACKS[track]['name'],
-                        "config": self.irw.TRACKS[track]['config'],
-                        "lowerNameAndConfig": self.irw.TRACKS[track]['lowerNameAndConfig'],
-                        "catid": self.irw.TRACKS[track]['catid'],
-                        "freeWithSubscription": self.irw.TRACKS[track]['freeWithSubscription'],
-                    })
-            if tracks:
-                Track.insert_many(tracks).execute()
-
-            print("Updating Series.")
-            seasons = []
-            self.current_seasons = {}
-            self.current_seasonids = []
-            self.collected_seasons = {}
-            query = Series.select()
-            for res in query:
-                self.collected_seasons[res.seasonid] = res.seriesname
-                if self.args.seasons:
-                    print("seasonid {} = {}".format(res.seasonid, res.seriesname))
-            if self.args.seasons:    
-                return True
-
-            seasons = ['2019-2']
-
-            for season in seasons:
-                year, quarter = season.split('-')
-                try:
-                    r = self.irw.results_archive(race_type=ct.RACE_TYPE_ROAD, event_types=ct.ALL, date_range=ct.ALL, season=(year, quarter, ct.ALL))
-                    event_count = r[1]
-                    print("Events found: {}".format(event_count))
-                    i = 0
-                    if event_count > 0:
-                        res = r[0]
-                        page_count = event_count / 25
-                        page_count += 1
-                        for event in res:
-                            print_progress(i, event_count, prefix="Progress: ", suffix="of events collected  ")
-                            Event.insert(**event).on_conflict('IGNORE').execute()
-                            i += 1
-                        page = 2
-
-                        while page < page_count:
-                            r = self.irw.results_archive(race_type=ct.RACE_TYPE_ROAD, event_types=ct.ALL, date_range=ct.ALL, season=(year, quarter, ct.ALL), page=page)
-                            res = r[0]
-                            for event in res:
-                                print_progress(i, event_count, prefix="Progress: ", suffix="of events collected  ")
-                                Event.insert(**event).on_conflict('IGNORE').execute()
-                                i += 1
-                            page += 1
-
-                        events_q = Event.select(Event.subsessionid).distinct()
-                        subsessionids = [r.subsessionid for r in events_q]
-
-                        if len(subsessionids) == 0:
-                            print("No races found")
-                        else:                    
-                            self.collect_results(subsessionids)
-                except:
-                    pass
+# requests per second to the stats site when --rate-limit isn't given
+DEFAULT_RATE_LIMIT = 4.0
 
 
 class App(object):
@@ -296,21 +72,59 @@ class App(object):
         self.args = args
         self.cfg = cfg
 
-        self.irw = iRWebStats(verbose=False)
+        db_path = database_file(self.cfg, self.args.configfile)
+        init_db(db_path, database_pragmas(self.cfg))
+
+        if self.args.replay:
+            print("Replaying recorded responses from {}".format(self.args.replay))
+            self.irw = ReplayWebStats(self.args.replay, latency=self.args.replay_latency,
+                                      jitter=self.args.replay_latency, error_rate=self.args.replay_error_rate)
+        else:
+            self.irw = iRWebStats(verbose=False)
+            # keep-alive connections, enough for every fetch worker to hold one
+            pooled_session(self.irw, connections=self.args.fetch_workers)
         print("Logging in...")
         self.irw.login(self.args.username, self.args.password, get_info=True)
 
+        # a replay measures the collector itself, it only gets the live site's budget and retries when asked for
+        if not self.args.replay or self.args.rate_limit is not None:
+            rate = DEFAULT_RATE_LIMIT if self.args.rate_limit is None else self.args.rate_limit
+            # one request budget shared by every pool, below the cache so hits don't spend it
+            limiter = AdaptiveRateLimiter(rate, min_rate=self.args.min_rate_limit)
+            self.irw = ThrottledWebStats(self.irw, limiter, self.args.username, self.args.password,
+                                         retries=self.args.http_retries, backoff=self.args.http_backoff)
+
+        self.cache = None
+        if not self.args.no_cache and not self.args.replay:
+            cache_file = self.args.cache_file or os.path.splitext(db_path)[0] + ".cache.sqlite3"
+            self.cache = ResponseCache(cache_file, max_bytes=self.args.cache_size * 1024 * 1024)
+            self.irw = CachedWebStats(self.irw, self.cache, current_season_ttl=self.args.cache_ttl)
+
+        if self.args.record:
+            print("Recording responses to {}".format(self.args.record))
+            self.irw = RecordingWebStats(self.irw, self.args.record)
+
         self.log.info("{}: {}".format(__program__, __version__))
         if self.args.debug:
             print("Version {}: {}".format(__program__, __version__))
 
     def run(self):
+        exporter = MetricsExporter(metrics, interval=self.args.metrics_interval, path=self.args.metrics_file, log=self.log)
+        exporter.start()
         t = Worker(self)
         t.start()
         try:
             t.join_with_exception()
         except MyException as e:
             print("{}".format(e))
+        finally:
+            exporter.stop()
+            if self.args.profile:
+                print("Profile saved to {}".format(self.args.profile))
+            if self.cache:
+                stats = self.cache.stats()
+                print("Response cache: {hits} hits, {misses} misses, {evictions} evicted, {bytes} bytes stored".format(**stats))
+                self.log.info("Response cache stats: {}".format(stats))
 
 
 def parse_args(argv):
@@ -325,15 +139,42 @@ def parse_args(argv):
     parser.add_argument("--test", action='store_true', default=False)
     parser.add_argument("-u", "--username", help="your iRacing username (ie: email address you signed up with)", default=None)
     parser.add_argument("-p", "--password", help="your iRacing password (I promise I don't harvest these....)", default=None)
-    parser.add_argument('-y', '--year', type=int, default=[], help='the year(s) to collect results for')
-    parser.add_argument('-q', '--quarter', type=int, default=[], help='the quarter(s) to collect results for')
+    parser.add_argument('-y', '--year', type=int, nargs='+', default=[], help='the year(s) to collect results for, defaults to the current season')
+    parser.add_argument('-q', '--quarter', type=int, nargs='+', choices=[1, 2, 3, 4], default=[], help='the quarter(s) to collect results for, defaults to all of them')
+    parser.add_argument("--race-type", nargs='+', choices=sorted(RACE_TYPES), default=['road'], help="the race type(s) to collect results for")
+    parser.add_argument("--fetch-workers", type=int, default=4, help="number of requests to have in flight at once")
+    parser.add_argument("--workers", type=int, default=1, help="processes parsing results, more than 1 helps when back-filling from the cache or a replay")
+    parser.add_argument("--rate-limit", type=float, default=None, help="maximum requests per second across all workers (0 for no limit), defaults to {} and to none with --replay".format(DEFAULT_RATE_LIMIT))
+    parser.add_argument("--min-rate-limit", type=float, default=0.25, help="requests per second the rate limit never backs off below")
+    parser.add_argument("--http-retries", type=int, default=3, help="times a throttled or failed request is retried straight away, before it goes back to the job queue")
+    parser.add_argument("--http-backoff", type=float, default=1.0, help="base seconds of the jittered exponential backoff between those retries")
+    parser.add_argument("--bulk-load", action='store_true', default=False, help="trade durability for speed while writing, for an initial import")
+    parser.add_argument("--no-cache", action='store_true', default=False, help="always fetch from the stats site, ignoring the response cache")
+    parser.add_argument("--cache-file", default=None, help="response cache file, defaults to <database>.cache.sqlite3")
+    parser.add_argument("--cache-size", type=int, default=2048, help="response cache size limit in MB")
+    parser.add_argument("--cache-ttl", type=float, default=3600, help="seconds archive pages of the current season are cached for")
+    parser.add_argument("--record", metavar="DIR", default=None, help="save every archive and results response to DIR for --replay")
+    parser.add_argument("--replay", metavar="DIR", default=None, help="serve responses recorded with --record from DIR instead of the stats site")
+    parser.add_argument("--replay-latency", type=float, default=0.0, help="seconds each replayed request takes, plus up to as much again of jitter")
+    parser.add_argument("--replay-error-rate", type=float, default=0.0, help="fraction of replayed requests that fail")
+    parser.add_argument("--flush-rows", type=int, default=5000, help="number of buffered rows which triggers a database write")
+    parser.add_argument("--resume", action='store_true', default=False, help="carry on with the jobs left by a previous run instead of starting over")
+    parser.add_argument("--max-attempts", type=int, default=5, help="number of times a failing request is tried before it is given up on")
+    parser.add_argument("--retry-backoff", type=float, default=30.0, help="seconds to wait before the first retry of a failed request, doubled on each further attempt")
+    parser.add_argument("--seasons", action='store_true', default=False, help="list the seasons in the database and exit")
+    parser.add_argument("--laps", action='store_true', default=False, help="also collect the lap chart of every race, one more request per race")
+    parser.add_argument("--flush-interval", type=float, default=10.0, help="maximum seconds rows are buffered before being written")
+    parser.add_argument("--metrics-file", default=None, help="append metrics to this file as JSON lines, or keep it as a Prometheus textfile if it ends in .prom")
+    parser.add_argument("--metrics-interval", type=float, default=60.0, help="seconds between metrics exports to the log and --metrics-file")
+    parser.add_argument("--profile", metavar="FILE", default=None, help="profile the collection and save the result to FILE")
+    parser.add_argument("--profiler", choices=['cprofile', 'pyinstrument'], default='cprofile', help="profiler used by --profile, pyinstrument writes an HTML report")
 
     # uncomment this if you want to force at least one command line option
     # if len(sys.argv)==1:
     #    parser.print_help()
     #    sys.exit(1)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv[1:])
 
     return args
 
@@ -394,6 +235,7 @@ def main(raw_args):
         config['Options'] = {}
         config['Options']['weekly_minimum_count'] = '3'
         config['Options']['season_minimum_week_percent'] = '75'
+        config['Database'] = dict((key, str(value)) for key, value in DEFAULT_PRAGMAS.items())
         config.write()
 
         # if we need the user to put something in the config uncomment this
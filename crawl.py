@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Plans the results archive crawl.
+
+    The --year, --quarter and --race-type arguments are expanded into one
+    season key per year, quarter and race type. Page 1 of each season is
+    queued first, and its event count says how many more pages it has.
+"""
+
+import math
+import datetime
+
+from ir_webstats_rc import constants as ct
+
+# the stats site's category ids, dirt was added after some versions of the client constants
+RACE_TYPES = {
+    'oval': ct.RACE_TYPE_OVAL,
+    'road': ct.RACE_TYPE_ROAD,
+    'dirt_oval': getattr(ct, 'RACE_TYPE_DIRT_OVAL', 3),
+    'dirt_road': getattr(ct, 'RACE_TYPE_DIRT_ROAD', 4),
+}
+
+ARCHIVE_PAGE_SIZE = 25
+
+
+def current_season(today=None):
+    today = today or datetime.date.today()
+    return today.year, (today.month - 1) // 3 + 1
+
+
+def season_key(year, quarter, race_type):
+    return "{}-{}-{}".format(year, quarter, race_type)
+
+
+def split_season_key(key):
+    year, quarter, race_type = key.split('-', 2)
+    return int(year), int(quarter), race_type
+
+
+def plan_seasons(years=None, quarters=None, race_types=None, today=None):
+    """ The season keys to crawl, oldest first.
+
+        No years means the current season only. No quarters means all four,
+        leaving out quarters that haven't started yet.
+    """
+    current = current_season(today)
+    if not years:
+        years = [current[0]]
+        quarters = quarters or [current[1]]
+    quarters = quarters or [1, 2, 3, 4]
+    race_types = race_types or ['road']
+    return [season_key(year, quarter, race_type)
+            for year in sorted(set(years))
+            for quarter in sorted(set(quarters))
+            if (year, quarter) <= current
+            for race_type in race_types]
+
+
+def page_count(event_count):
+    return int(math.ceil(event_count / float(ARCHIVE_PAGE_SIZE)))
+
+
+def archive_query(key, page):
+    """ The keyword arguments of results_archive() for one page of a season """
+    year, quarter, race_type = split_season_key(key)
+    return dict(race_type=RACE_TYPES[race_type], event_types=ct.ALL, date_range=ct.ALL,
+                season=(year, quarter, ct.ALL), page=page)
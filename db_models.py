@@ -1,12 +1,57 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+""" The database models.
+
+    Importing this module does not touch the database. Call init_db() to
+    pick the file and connection settings, otherwise the first query opens
+    the database named in config.ini (or DEFAULT_DB_FILE) with the default
+    settings. Either way the schema is checked and migrated once, when the
+    database is opened.
+"""
+
 import os
-import sys
+import math
+import threading
+from contextlib import contextmanager
 from peewee import *
 
-db_file = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), "159155.sqlite3")
-db = SqliteDatabase(db_file)
+DEFAULT_CONFIG_FILE = 'config.ini'
+DEFAULT_DB_FILE = 'database.sqlite3'
+
+# connection settings, each can be overridden in the [Database] section of config.ini
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'wal',      # readers keep working while collect.py writes
+    'synchronous': 'normal',    # with WAL this is safe against corruption, only a crash can lose the last commits
+    'cache_size': -64000,       # negative means KiB, so 64MB of page cache
+    'mmap_size': 268435456,
+    'temp_store': 'memory',
+    'busy_timeout': 10000,      # milliseconds to wait for another connection's lock
+}
+
+# applied on top of the above for the duration of an initial import, see bulk_load()
+BULK_LOAD_PRAGMAS = {
+    'synchronous': 'off',
+    'cache_size': -256000,
+}
+
+
+
+class LazyDatabase(DatabaseProxy):
+    """ A DatabaseProxy which calls init_db() with the defaults the first
+        time it is used without having been initialized
+    """
+
+    def __getattr__(self, attr):
+        if self.obj is None:
+            with _init_lock:
+                if self.obj is None:
+                    init_db()
+        return getattr(self.obj, attr)
+
+
+db = LazyDatabase()
+_init_lock = threading.RLock()
 
 
 class BaseModel(Model):
@@ -31,6 +76,9 @@ class SeriesResult(BaseModel):
         order_by = ('starttime',)
         db_table = 'series_result'
         primary_key = CompositeKey("subsessionid", "carclassid")
+        indexes = (
+            (('seasonid', 'week_num'), False),
+        )
 
 
 class Team(BaseModel):
@@ -94,6 +142,11 @@ class Event(BaseModel):
     class Meta:
         order_by = ('subsessionid',)
         db_table = 'events'
+        indexes = (
+            (('subsessionid', 'carclassid'), True),
+            (('seasonid', 'race_week_num'), False),
+            (('trackid',), False),
+        )
 
 class EventResult(BaseModel):
     subsessionid = IntegerField()
@@ -137,6 +190,38 @@ class EventResult(BaseModel):
         order_by = ('sessionid', 'FinPos')
         db_table = 'event_result'
         primary_key = CompositeKey("subsessionid", "custid")
+        indexes = (
+            (('custid',), False),
+            (('carclassid',), False),
+        )
+
+
+class CollectedSubsession(BaseModel):
+    subsessionid = IntegerField(primary_key=True)
+    results = IntegerField()
+
+
+    class Meta:
+        order_by = ('subsessionid',)
+        db_table = 'collected_subsessions'
+
+
+class CollectionJob(BaseModel):
+    kind = CharField()
+    key = CharField()
+    state = CharField(default='pending')
+    attempts = IntegerField(default=0)
+    next_attempt = FloatField(default=0)
+    last_error = TextField(null = True)
+
+
+    class Meta:
+        order_by = ('id',)
+        db_table = 'collection_jobs'
+        indexes = (
+            (('kind', 'key'), True),
+            (('kind', 'state'), False),
+        )
 
 
 class Car(BaseModel):
@@ -193,21 +278,336 @@ class Series(BaseModel):
         db_table = 'series'
 
 
-db.connect()
-
-if not SeriesResult.table_exists():
-    db.create_tables([SeriesResult,], safe=True)
-if not Team.table_exists():
-    db.create_tables([Team,], safe=True)
-if not Event.table_exists():
-    db.create_tables([Event,], safe=True)
-if not EventResult.table_exists():
-    db.create_tables([EventResult,], safe=True)
-if not Car.table_exists():
-    db.create_tables([Car,], safe=True)
-if not CarClass.table_exists():
-    db.create_tables([CarClass,], safe=True)
-if not Track.table_exists():
-    db.create_tables([Track,], safe=True)
-if not Series.table_exists():
-    db.create_tables([Series,], safe=True)
+class DriverWeekStats(BaseModel):
+    custid = IntegerField()
+    seasonid = IntegerField()
+    race_week_num = IntegerField()
+    starts = IntegerField(default=0)
+    wins = IntegerField(default=0)
+    finpos_sum = IntegerField(default=0)
+    incidents = IntegerField(default=0)
+    laps = IntegerField(default=0)
+    points = IntegerField(default=0)
+    irating_delta = IntegerField(default=0)
+    best_lap = FloatField(null = True)
+
+    @property
+    def avg_finish(self):
+        return self.finpos_sum / float(self.starts) if self.starts else None
+
+    @property
+    def incidents_per_race(self):
+        return self.incidents / float(self.starts) if self.starts else None
+
+    @property
+    def incidents_per_lap(self):
+        return self.incidents / float(self.laps) if self.laps else None
+
+
+    class Meta:
+        order_by = ('custid', 'seasonid', 'race_week_num')
+        db_table = 'driver_week_stats'
+        primary_key = CompositeKey("custid", "seasonid", "race_week_num")
+        indexes = (
+            (('seasonid', 'race_week_num'), False),
+        )
+
+
+class SeriesClassStats(BaseModel):
+    seasonid = IntegerField()
+    carclassid = IntegerField()
+    races = IntegerField(default=0)
+    starts = IntegerField(default=0)
+    incidents = IntegerField(default=0)
+    laps = IntegerField(default=0)
+    irating_delta = IntegerField(default=0)
+    best_lap = FloatField(null = True)
+    best_lap_custid = IntegerField(null = True)
+
+    @property
+    def avg_field_size(self):
+        return self.starts / float(self.races) if self.races else None
+
+    @property
+    def incidents_per_lap(self):
+        return self.incidents / float(self.laps) if self.laps else None
+
+
+    class Meta:
+        order_by = ('seasonid', 'carclassid')
+        db_table = 'series_class_stats'
+        primary_key = CompositeKey("seasonid", "carclassid")
+
+
+class TrackCarStats(BaseModel):
+    trackid = IntegerField()
+    carid = IntegerField()
+    races = IntegerField(default=0)
+    starts = IntegerField(default=0)
+    incidents = IntegerField(default=0)
+    laps = IntegerField(default=0)
+    avg_lap_sum = FloatField(default=0)
+    avg_lap_count = IntegerField(default=0)
+    best_lap = FloatField(null = True)
+    best_lap_custid = IntegerField(null = True)
+    best_lap_subsessionid = IntegerField(null = True)
+
+    @property
+    def avg_lap(self):
+        return self.avg_lap_sum / self.avg_lap_count if self.avg_lap_count else None
+
+
+    class Meta:
+        order_by = ('trackid', 'carid')
+        db_table = 'track_car_stats'
+        primary_key = CompositeKey("trackid", "carid")
+
+
+class RatingHistory(BaseModel):
+    custid = IntegerField()
+    carcategory = IntegerField()
+    raw_start_time = IntegerField()
+    subsessionid = IntegerField()
+    oldirating = IntegerField(null = True)
+    newirating = IntegerField(null = True)
+    oldlicenselevel = IntegerField(null = True)
+    oldlicensesublevel = IntegerField(null = True)
+    newlicenselevel = IntegerField(null = True)
+    newlicensesublevel = IntegerField(null = True)
+
+
+    class Meta:
+        order_by = ('custid', 'carcategory', 'raw_start_time')
+        db_table = 'rating_history'
+        primary_key = CompositeKey("custid", "carcategory", "raw_start_time")
+        # stored in key order, a driver's history in a category is one contiguous range
+        without_rowid = True
+
+
+class AggregatedSubsession(BaseModel):
+    subsessionid = IntegerField(primary_key=True)
+
+
+    class Meta:
+        order_by = ('subsessionid',)
+        db_table = 'aggregated_subsessions'
+
+
+class Lap(BaseModel):
+    subsessionid = IntegerField()
+    custid = IntegerField()
+    lapnum = IntegerField()
+    laptime = IntegerField(null = True)
+    flags = IntegerField()
+
+
+    class Meta:
+        order_by = ('subsessionid', 'custid', 'lapnum')
+        db_table = 'laps'
+        primary_key = CompositeKey("subsessionid", "custid", "lapnum")
+
+
+class LapSummary(BaseModel):
+    subsessionid = IntegerField()
+    custid = IntegerField()
+    laps = IntegerField()
+    best_laptime = IntegerField(null = True)
+    clean_laps = IntegerField()
+    pitted = IntegerField()
+    off_tracks = IntegerField()
+    black_flags = IntegerField()
+    contacts = IntegerField()
+    car_contacts = IntegerField()
+    lost_controls = IntegerField()
+    tows = IntegerField()
+
+
+    class Meta:
+        order_by = ('subsessionid', 'custid')
+        db_table = 'lap_summaries'
+        primary_key = CompositeKey("subsessionid", "custid")
+        indexes = (
+            (('custid',), False),
+        )
+
+
+class CollectedLapChart(BaseModel):
+    subsessionid = IntegerField(primary_key=True)
+    laps = IntegerField()
+
+
+    class Meta:
+        order_by = ('subsessionid',)
+        db_table = 'collected_lapcharts'
+
+
+# the steps below spell out the tables and indexes of their own version rather than
+# creating whatever the models declare today, so each version is always the same schema
+
+def _create_table(model, indexes=()):
+    """ Create `model`'s table with just `indexes`, ((column, ...), unique) pairs """
+    model._schema.create_table(safe=True)
+    for columns, unique in indexes:
+        db.execute(model.index(*[getattr(model, name) for name in columns], unique=unique))
+
+
+def _create_tables():
+    for model in [SeriesResult, Team, Event, EventResult, CollectedSubsession, Car, CarClass, Track, Series]:
+        _create_table(model)
+    _create_table(CollectionJob, [(('kind', 'key'), True), (('kind', 'state'), False)])
+    # seed the collected subsession ledger from whatever an older version already collected
+    CollectedSubsession.insert_from(
+        EventResult.select(EventResult.subsessionid, fn.COUNT(EventResult.custid)).group_by(EventResult.subsessionid),
+        [CollectedSubsession.subsessionid, CollectedSubsession.results]).on_conflict('IGNORE').execute()
+
+
+def _create_indexes():
+    # on tables created before there were any
+    _create_table(SeriesResult, [(('seasonid', 'week_num'), False)])
+    _create_table(Event, [(('subsessionid',), False), (('seasonid', 'race_week_num'), False)])
+    _create_table(EventResult, [(('custid',), False), (('carclassid',), False)])
+
+
+def _create_aggregates():
+    # fill the new tables from the results collected so far
+    from aggregates import rebuild_totals
+    _create_table(DriverWeekStats, [(('seasonid', 'race_week_num'), False)])
+    for model in [SeriesClassStats, TrackCarStats, AggregatedSubsession]:
+        _create_table(model)
+    rebuild_totals()
+
+
+def _unique_events():
+    # an event is listed once per car class, let the database drop the repeats
+    db.execute_sql('DELETE FROM events WHERE id NOT IN '
+                   '(SELECT MIN(id) FROM events GROUP BY subsessionid, COALESCE(carclassid, 0))')
+    db.execute_sql('DROP INDEX IF EXISTS event_subsessionid')
+    _create_table(Event, [(('subsessionid', 'carclassid'), True)])
+
+
+def _create_lap_tables():
+    _create_table(Lap)
+    _create_table(LapSummary, [(('custid',), False)])
+    _create_table(CollectedLapChart)
+
+
+def _index_event_tracks():
+    # for queries.track_records
+    _create_table(Event, [(('trackid',), False)])
+
+
+def _derive_series_results():
+    from aggregates import rebuild_series_results
+    rebuild_series_results()
+
+
+def _create_rating_history():
+    from aggregates import rebuild_rating_history
+    _create_table(RatingHistory)
+    rebuild_rating_history()
+
+
+# each step upgrades the schema by one version, append new steps to the end
+MIGRATIONS = [
+    _create_tables,
+    _create_indexes,
+    _create_aggregates,
+    _unique_events,
+    _create_lap_tables,
+    _index_event_tracks,
+    _derive_series_results,
+    _create_rating_history,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version():
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def migrate():
+    """ Bring the database schema up to SCHEMA_VERSION, recording progress
+        in SQLite's user_version so each step only ever runs once
+    """
+    version = schema_version()
+    for number, step in enumerate(MIGRATIONS[version:], version + 1):
+        with db.atomic():
+            step()
+            db.execute_sql('PRAGMA user_version = {}'.format(number))
+
+
+def database_pragmas(cfg):
+    """ The connection pragmas from the [Database] section of the config,
+        with DEFAULT_PRAGMAS for anything not set there
+    """
+    section = cfg.get('Database', {})
+    return dict((key, section.get(key, value)) for key, value in DEFAULT_PRAGMAS.items())
+
+
+def database_file(cfg, config_file=DEFAULT_CONFIG_FILE):
+    """ The database_file from the config, relative to the config file's directory """
+    return os.path.join(os.path.dirname(os.path.abspath(config_file)), cfg.get('database_file', DEFAULT_DB_FILE))
+
+
+class StrengthOfField(object):
+    """ The sof(irating) SQL aggregate: iRacing's strength of field, the
+        rating whose exponential average matches that of the field. Ratings
+        of 0 or less (none yet) are left out.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+
+    def step(self, irating):
+        if irating is not None and irating > 0:
+            self.count += 1
+            self.total += math.exp(-irating * math.log(2) / 1600)
+
+    def finalize(self):
+        if not self.count:
+            return None
+        return int(round(1600 / math.log(2) * math.log(self.count / self.total)))
+
+
+def init_db(path=None, pragmas=None):
+    """ Open the database at `path` with connection `pragmas`, migrating its
+        schema if need be. Without a path, the database_file and [Database]
+        settings are read from config.ini in the working directory, if there
+        is one. Can be called again to switch to another database.
+    """
+    with _init_lock:
+        if path is None:
+            cfg = {}
+            if os.path.isfile(DEFAULT_CONFIG_FILE):
+                import configobj
+                cfg = configobj.ConfigObj(DEFAULT_CONFIG_FILE)
+            path = database_file(cfg)
+            pragmas = pragmas or database_pragmas(cfg)
+        pragmas = pragmas or DEFAULT_PRAGMAS
+        if db.obj is not None:
+            db.obj.close()
+        database = SqliteDatabase(path, pragmas=list(pragmas.items()))
+        database.register_aggregate(StrengthOfField, 'sof', 1)
+        db.initialize(database)
+        database.connect()
+        migrate()
+    return database
+
+
+@contextmanager
+def bulk_load(pragmas=None):
+    """ Relax durability on this thread's connection while the block runs,
+        putting the previous settings back afterwards. Only worth it for an
+        initial import, where a crash just means starting the import again.
+    """
+    pragmas = pragmas or BULK_LOAD_PRAGMAS
+    saved = dict((key, db.pragma(key)) for key in pragmas)
+    for key, value in pragmas.items():
+        db.pragma(key, value)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            db.pragma(key, value)
+
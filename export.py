@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Export the collected results to Parquet or Arrow files for analysis
+    outside the ORM.
+
+    python export.py [--configfile FILE] [-o DIR] [--format parquet|arrow]
+
+    events and event_result are written under DIR as hive style partitions,
+
+        DIR/events/season_year=2019/season_quarter=2/part-<run>.parquet
+        DIR/event_result/season_year=2019/season_quarter=2/part-<run>.parquet
+
+    which pandas (pyarrow.dataset), polars and duckdb read as one table.
+    Columns are typed from the db_models fields, so lap times are floats and
+    iRatings integers. Each run only appends the subsessions that are not in
+    DIR yet, and streams them from SQLite in batches so memory use does not
+    grow with the size of the database. The reference tables are small and
+    are rewritten whole every run.
+
+    Needs pyarrow.
+"""
+
+import os
+import sys
+import time
+import uuid
+import argparse
+import configobj
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from db_models import db, init_db, database_file, database_pragmas, Event, EventResult, Team, Car, CarClass, Track, Series
+
+BATCH_ROWS = 50000
+PARTITION_COLUMNS = ['season_year', 'season_quarter']
+REFERENCE_MODELS = [Team, Car, CarClass, Track, Series]
+EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def arrow_type(field):
+    if field.field_type in ('INT', 'AUTO', 'BIGINT', 'SMALLINT'):
+        return pa.int64()
+    if field.field_type in ('FLOAT', 'DOUBLE', 'DECIMAL'):
+        return pa.float64()
+    return pa.string()
+
+
+def arrow_schema(model, exclude=()):
+    return pa.schema([(field.column_name, arrow_type(field))
+                      for field in model._meta.sorted_fields if field.column_name not in exclude])
+
+
+def _coerce(value, type_):
+    # SQLite keeps whatever the site sent when it doesn't fit the column's affinity
+    if value is None or value == '':
+        return None
+    try:
+        if type_ == pa.int64():
+            return int(value)
+        if type_ == pa.float64():
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+def record_batch(rows, schema, offset=0):
+    """ A RecordBatch of `schema` from row tuples, whose columns start at `offset` """
+    arrays = []
+    for i, field in enumerate(schema, offset):
+        column = [row[i] for row in rows]
+        try:
+            arrays.append(pa.array(column, type=field.type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+            arrays.append(pa.array([_coerce(value, field.type) for value in column], type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class PartitionedWriter(object):
+    """ Writes record batches of one table into season_year/season_quarter
+        partitions, each under a temporary name until commit()
+    """
+
+    def __init__(self, directory, table, schema, run, file_format='parquet'):
+        self.directory = os.path.join(directory, table)
+        self.schema = schema
+        self.run = run
+        self.file_format = file_format
+        self.rows = 0
+        self._writers = {}
+
+    def _writer(self, partition):
+        if partition not in self._writers:
+            path = os.path.join(self.directory, *['{}={}'.format(name, value) for name, value in zip(PARTITION_COLUMNS, partition)])
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, 'part-{}{}'.format(self.run, EXTENSIONS[self.file_format]))
+            if self.file_format == 'arrow':
+                writer = pa.ipc.new_file(path + '.tmp', self.schema)
+            else:
+                writer = pq.ParquetWriter(path + '.tmp', self.schema)
+            self._writers[partition] = (path, writer)
+        return self._writers[partition][1]
+
+    def write(self, partition, batch):
+        writer = self._writer(partition)
+        if self.file_format == 'arrow':
+            writer.write_batch(batch)
+        else:
+            writer.write_table(pa.Table.from_batches([batch]))
+        self.rows += batch.num_rows
+
+    def close(self):
+        for path, writer in self._writers.values():
+            writer.close()
+
+    def commit(self):
+        for path, writer in self._writers.values():
+            os.replace(path + '.tmp', path)
+
+
+def exported_subsessionids(directory):
+    """ Yield the distinct subsessionids of each events file under
+        `directory`. Only that column is read, and events has a row per
+        class of a race rather than per driver, races without results
+        included.
+    """
+    for root, dirs, files in os.walk(os.path.join(directory, Event._meta.table_name)):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith('.parquet'):
+                column = pq.read_table(path, columns=['subsessionid']).column(0)
+            elif name.endswith('.arrow'):
+                with pa.memory_map(path) as source:
+                    column = pa.ipc.open_file(source).read_all().column('subsessionid')
+            else:
+                continue
+            yield pc.unique(column).to_pylist()
+
+
+def export_partitioned(sql, writer, batch_rows=BATCH_ROWS):
+    """ Stream the rows of `sql`, which selects the partition columns first
+        and is ordered by them, into `writer`
+    """
+    cursor = db.execute_sql(sql)
+    while True:
+        rows = cursor.fetchmany(batch_rows)
+        if not rows:
+            break
+        start = 0
+        # split the fetched rows where the partition changes
+        for i in range(1, len(rows) + 1):
+            if i == len(rows) or rows[i][:2] != rows[start][:2]:
+                writer.write(tuple(rows[start][:2]), record_batch(rows[start:i], writer.schema, offset=2))
+                start = i
+
+
+def export_reference(directory, model, file_format='parquet'):
+    schema = arrow_schema(model)
+    columns = ', '.join('"{}"'.format(field.name) for field in schema)
+    rows = db.execute_sql('SELECT {} FROM "{}"'.format(columns, model._meta.table_name)).fetchall()
+    table = pa.Table.from_batches([record_batch(rows, schema)], schema=schema)
+    path = os.path.join(directory, model._meta.table_name + EXTENSIONS[file_format])
+    if file_format == 'arrow':
+        with pa.ipc.new_file(path + '.tmp', schema) as writer:
+            writer.write_table(table)
+    else:
+        pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return len(rows)
+
+
+def export(directory, file_format='parquet', batch_rows=BATCH_ROWS):
+    """ Append the subsessions not exported yet to `directory`, and rewrite
+        the reference tables. Returns the number of rows written per table.
+    """
+    # unique, so files of two runs within the same second don't replace each other
+    run = '{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+    os.makedirs(directory, exist_ok=True)
+
+    # collected subsessions that aren't in the export yet, with the season of their event
+    db.execute_sql('CREATE TEMP TABLE IF NOT EXISTS exported (subsessionid INTEGER PRIMARY KEY)')
+    db.execute_sql('DELETE FROM temp.exported')
+    for subsessionids in exported_subsessionids(directory):
+        db.cursor().executemany('INSERT OR IGNORE INTO temp.exported VALUES (?)', [(s,) for s in subsessionids])
+    db.execute_sql('DROP TABLE IF EXISTS temp.export_batch')
+    db.execute_sql(
+        'CREATE TEMP TABLE export_batch AS '
+        'SELECT e.subsessionid, MIN(e.season_year) AS season_year, MIN(e.season_quarter) AS season_quarter '
+        'FROM events e JOIN collected_subsessions c ON c.subsessionid = e.subsessionid '
+        'WHERE e.subsessionid NOT IN (SELECT subsessionid FROM temp.exported) '
+        'GROUP BY e.subsessionid')
+
+    counts = {}
+    writers = []
+    for model in (Event, EventResult):
+        table = model._meta.table_name
+        schema = arrow_schema(model, exclude=PARTITION_COLUMNS)
+        columns = ', '.join('t."{}"'.format(field.name) for field in schema)
+        sql = ('SELECT b.season_year, b.season_quarter, {} FROM "{}" t '
+               'JOIN temp.export_batch b ON b.subsessionid = t.subsessionid '
+               'ORDER BY b.season_year, b.season_quarter, t.subsessionid').format(columns, table)
+        writer = PartitionedWriter(directory, table, schema, run, file_format)
+        try:
+            export_partitioned(sql, writer, batch_rows)
+        finally:
+            writer.close()
+        writers.append(writer)
+        counts[table] = writer.rows
+    # events go last, they are what the next run reads to see what was exported
+    for writer in reversed(writers):
+        writer.commit()
+    db.execute_sql('DROP TABLE temp.export_batch')
+
+    for model in REFERENCE_MODELS:
+        counts[model._meta.table_name] = export_reference(directory, model, file_format)
+    return counts
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="export the collected results to Parquet or Arrow files")
+    parser.add_argument("--configfile", help="config file", default="config.ini")
+    parser.add_argument("-o", "--output", default="export", help="directory to write the files to")
+    parser.add_argument("--format", choices=sorted(EXTENSIONS), default='parquet', help="parquet files, or arrow IPC files which can be memory mapped")
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="rows read from the database at a time")
+    return parser.parse_args(argv[1:])
+
+
+def main(raw_args):
+    args = parse_args(raw_args)
+    if pa is None:
+        print("The export needs pyarrow, install it with: pip install pyarrow")
+        return 1
+    cfg = configobj.ConfigObj(args.configfile) if os.path.isfile(args.configfile) else {}
+    init_db(database_file(cfg, args.configfile), database_pragmas(cfg))
+
+    start = time.time()
+    counts = export(args.output, args.format, args.batch_rows)
+    for table, rows in counts.items():
+        print("{}: {} rows".format(table, rows))
+    print("Exported to {} in {:.1f} seconds".format(args.output, time.time() - start))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Bounded thread pool used to overlap the network calls made against the
+    iRacing stats site. The request budget is kept by outbound.ThrottledWebStats,
+    which the fetch functions go through.
+
+    Only the fetching runs on the pool threads. Results are handed back to the
+    calling thread in completion order so that a single thread does all of the
+    database writing.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from metrics import metrics
+
+
+class FetchPool(object):
+    """ Runs `fetch(key)` for many keys on a fixed number of worker threads.
+
+        At most `workers * 2` calls are queued or in flight at any time, so
+        the keys can come from a (lazy) generator of any length. Each call is
+        timed as `http.<name>` in the metrics, along with the number of calls
+        in flight.
+    """
+
+    def __init__(self, fetch, workers=4, name='fetch'):
+        self.fetch = fetch
+        self.workers = max(1, workers)
+        self.name = name
+
+    def _call(self, key):
+        try:
+            with metrics.timer('http.' + self.name):
+                return self.fetch(key)
+        except Exception:
+            metrics.incr('http.{}.errors'.format(self.name))
+            raise
+
+    def map(self, keys):
+        """ Yield (key, future) pairs as the fetches complete.
+
+            Calling future.result() in the consuming thread returns the
+            payload or re-raises whatever the fetch raised, so errors surface
+            in the same thread that would have seen them without the pool.
+        """
+        max_pending = self.workers * 2
+        keys = iter(keys)
+        pending = {}
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < max_pending:
+                    try:
+                        key = next(keys)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[executor.submit(self._call, key)] = key
+                metrics.gauge('pool.{}.pending'.format(self.name), len(pending))
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    yield pending.pop(future), future
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" A persistent work queue kept in the collection_jobs table.
+
+    Every archive page and every subsession the collector has to fetch is a
+    job. Jobs move from pending to in_flight when they are claimed, then to
+    done, or to failed when the fetch raised. Failed jobs become claimable
+    again after an exponential backoff, until they run out of attempts.
+    Because the state is in the database, a later run can pick up exactly
+    where a crashed one stopped.
+"""
+
+import time
+import itertools
+
+from peewee import fn, Value
+
+from db_models import db, CollectionJob
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+ARCHIVE_PAGE = 'archive_page'
+SUBSESSION = 'subsession'
+LAPCHART = 'lapchart'
+
+# keeps "key IN (...)" lists under SQLite's bound variable limit
+IN_CHUNK = 500
+
+
+def archive_page_key(season, page):
+    return "{}/{}".format(season, page)
+
+
+def split_archive_page_key(key):
+    season, page = key.rsplit('/', 1)
+    return season, int(page)
+
+
+class JobQueue(object):
+    """ Queue operations for one collection run """
+
+    def __init__(self, max_attempts=5, backoff=30.0):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def _claimable(self, kind, now):
+        return ((CollectionJob.kind == kind) &
+                (CollectionJob.state << [PENDING, FAILED]) &
+                (CollectionJob.attempts < self.max_attempts) &
+                (CollectionJob.next_attempt <= now))
+
+    def add(self, kind, keys):
+        """ Queue new jobs, jobs which already exist are left as they are.
+            `keys` can be any iterable, it is read a chunk at a time.
+        """
+        keys = iter(keys)
+        with db.atomic():
+            while True:
+                rows = [{'kind': kind, 'key': str(key)} for key in itertools.islice(keys, IN_CHUNK)]
+                if not rows:
+                    break
+                CollectionJob.insert_many(rows).on_conflict('IGNORE').execute()
+
+    def add_from(self, kind, query):
+        """ Queue a job for each key selected by `query`, without the keys
+            ever leaving the database
+        """
+        keys = query.alias('keys')
+        select = (CollectionJob
+                  .select(Value(kind), keys.c.key.cast('TEXT'), Value(PENDING), Value(0), Value(0))
+                  .from_(keys))
+        return (CollectionJob
+                .insert_from(select, [CollectionJob.kind, CollectionJob.key, CollectionJob.state,
+                                      CollectionJob.attempts, CollectionJob.next_attempt])
+                .on_conflict('IGNORE')
+                .execute())
+
+    def claim(self, kind, limit=IN_CHUNK):
+        """ Mark up to `limit` of the due jobs of `kind` as in flight and return their keys """
+        now = time.time()
+        with db.atomic():
+            query = (CollectionJob
+                     .select(CollectionJob.id, CollectionJob.key)
+                     .where(self._claimable(kind, now))
+                     .order_by(CollectionJob.id)
+                     .limit(limit))
+            jobs = list(query.tuples())
+            if jobs:
+                CollectionJob.update(state=IN_FLIGHT).where(CollectionJob.id << [id for id, _ in jobs]).execute()
+        return [key for _, key in jobs]
+
+    def done(self, kind, keys):
+        keys = [str(key) for key in keys]
+        for start in range(0, len(keys), IN_CHUNK):
+            (CollectionJob
+             .update(state=DONE, last_error=None)
+             .where((CollectionJob.kind == kind) & (CollectionJob.key << keys[start:start + IN_CHUNK]))
+             .execute())
+
+    def failed(self, kind, key, error):
+        """ Record a failed attempt and schedule the retry """
+        job = CollectionJob.get((CollectionJob.kind == kind) & (CollectionJob.key == str(key)))
+        job.attempts += 1
+        job.state = FAILED
+        job.next_attempt = time.time() + self.backoff * 2 ** (job.attempts - 1)
+        job.last_error = "{}: {}".format(type(error).__name__, error)
+        job.save()
+
+    def next_retry(self, kind):
+        """ Seconds until the next failed job of `kind` can be retried, None if there is none """
+        query = (CollectionJob
+                 .select(fn.MIN(CollectionJob.next_attempt))
+                 .where((CollectionJob.kind == kind) &
+                        (CollectionJob.state << [PENDING, FAILED]) &
+                        (CollectionJob.attempts < self.max_attempts)))
+        next_attempt = query.scalar()
+        if next_attempt is None:
+            return None
+        return max(0.0, next_attempt - time.time())
+
+    def recover(self):
+        """ Queue again the jobs still in flight, which belong to a run that
+            died, and the failed jobs which ran out of attempts
+        """
+        with db.atomic():
+            count = CollectionJob.update(state=PENDING).where(CollectionJob.state == IN_FLIGHT).execute()
+            count += (CollectionJob
+                      .update(state=PENDING, attempts=0, next_attempt=0)
+                      .where((CollectionJob.state == FAILED) & (CollectionJob.attempts >= self.max_attempts))
+                      .execute())
+        return count
+
+    def clear(self):
+        return CollectionJob.delete().execute()
+
+    def counts(self, kind):
+        query = (CollectionJob
+                 .select(CollectionJob.state, fn.COUNT(CollectionJob.id))
+                 .where(CollectionJob.kind == kind)
+                 .group_by(CollectionJob.state))
+        return dict(query.tuples())
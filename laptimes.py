@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Lap time parsing for the values the stats site returns, such as
+    qualifytime, averagelaptime and fastestlaptime.
+
+    Times come as "M:SS.fff" or "SS.fff". "00.000" means there is no time,
+    and so does anything negative, zero or not a number at all, all of which
+    are returned as None (NaN in the NumPy path).
+
+    parse_laptime() converts a single value. parse_laptimes(), which
+    normalize.py uses while collecting, converts a whole column at once with
+    the NumPy functions. It falls back to parse_laptime() when NumPy isn't
+    installed, and for columns too short to make up for NumPy's overhead.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def parse_laptime(value):
+    """ Seconds as a float for one lap time, or None if there is no time """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        parts = value.split(':')
+        try:
+            seconds = float(parts[-1])
+            if len(parts) > 1:
+                minutes = 0
+                for part in parts[:-1]:
+                    minutes = minutes * 60 + int(part)
+                seconds += minutes * 60
+        except ValueError:
+            return None
+    # also rejects NaN, which compares false to everything
+    if seconds > 0:
+        return seconds
+    return None
+
+
+def laptime_array(values):
+    """ Parse a sequence of lap times into a float64 array, NaN where there is no time.
+
+        The strings are parsed as a matrix of bytes, one row per value, so the
+        digit arithmetic runs in NumPy rather than once per value in Python.
+        Rows it can't make sense of go through parse_laptime() instead.
+    """
+    if np is None:
+        raise ImportError("laptime_array needs numpy")
+    values = list(values)
+    if not values:
+        return np.empty(0, dtype=np.float64)
+    try:
+        text = np.array(values, dtype='S')
+    except (TypeError, UnicodeEncodeError):
+        text = np.array([b'' if not isinstance(v, str) else v.encode('ascii', 'replace') for v in values], dtype='S')
+    chars = text.view(np.uint8).reshape(len(text), -1)
+
+    count = len(values)
+    minutes = np.zeros(count, dtype=np.int64)
+    seconds = np.zeros(count, dtype=np.int64)
+    decimals = np.zeros(count, dtype=np.int64)
+    minute_digits = np.zeros(count, dtype=np.int64)
+    second_digits = np.zeros(count, dtype=np.int64)
+    colons = np.zeros(count, dtype=np.int64)
+    dots = np.zeros(count, dtype=np.int64)
+    invalid = np.zeros(count, dtype=bool)
+    has_minutes = (chars == 58).any(axis=1)
+    # one pass per character position, each one over every value at once
+    for column in chars.T:
+        is_digit = (column >= 48) & (column <= 57)
+        is_colon = column == 58
+        is_dot = column == 46
+        digit = column.astype(np.int64) - 48
+        in_minutes = is_digit & has_minutes & (colons == 0)
+        in_seconds = is_digit & ~in_minutes
+        minutes = np.where(in_minutes, minutes * 10 + digit, minutes)
+        # the seconds and their decimals as one integer, scaled down at the end
+        seconds = np.where(in_seconds, seconds * 10 + digit, seconds)
+        decimals += in_seconds & (dots > 0)
+        minute_digits += in_minutes
+        second_digits += in_seconds
+        invalid |= ~(is_digit | is_colon | is_dot | (column == 0)) | (is_colon & (dots > 0))
+        colons += is_colon
+        dots += is_dot
+    valid = (~invalid & (colons <= 1) & (dots <= 1) & (second_digits > 0) &
+             ((minute_digits > 0) | ~has_minutes) & (minute_digits + second_digits <= 15))
+    result = seconds / 10.0 ** decimals + minutes * 60
+
+    for i in np.flatnonzero(~valid):
+        t = parse_laptime(values[i])
+        result[i] = np.nan if t is None else t
+    result[~(result > 0)] = np.nan
+    return result
+
+
+# laptime_array() costs about 0.35 ms however few values it gets, below this many
+# values the loop over parse_laptime() is quicker
+ARRAY_MIN_VALUES = 500
+
+
+def parse_laptimes(values):
+    """ Parse a whole column of lap times, returning a list of floats and
+        Nones ready to be written to the database
+    """
+    values = list(values)
+    if np is None or len(values) < ARRAY_MIN_VALUES:
+        return [parse_laptime(v) for v in values]
+    return [None if t != t else t for t in laptime_array(values).tolist()]
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Counters, gauges and timers for the collection pipeline, a thread that
+    exports them periodically, and an optional profiler hook.
+
+    The pipeline records into the module level `metrics` registry, for
+    example
+
+        metrics.incr('db.rows', 25)
+        with metrics.timer('http.event_results'):
+            ...
+
+    MetricsExporter writes a snapshot every interval to the log, and to a
+    file as JSON lines, or as a Prometheus textfile when the file name ends
+    in .prom.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+
+# samples kept per timer between two snapshots, for the percentiles
+MAX_SAMPLES = 4096
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Metrics(object):
+    """ A thread safe registry of counters, gauges and timers """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._last_counters = {}
+        self._last_snapshot = self.started
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'samples': []}
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            if len(timer['samples']) < MAX_SAMPLES:
+                timer['samples'].append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """ Everything recorded so far, with per second rates of the counters
+            and timer percentiles covering the time since the last snapshot
+        """
+        now = time.time()
+        with self._lock:
+            elapsed = max(now - self._last_snapshot, 1e-9)
+            rates = dict((name, round((value - self._last_counters.get(name, 0)) / elapsed, 2))
+                         for name, value in self._counters.items())
+            timers = {}
+            for name, timer in self._timers.items():
+                ordered = sorted(timer['samples'])
+                timers[name] = {
+                    'count': timer['count'],
+                    'total_s': round(timer['total'], 4),
+                    'max_ms': round(timer['max'] * 1000, 3),
+                }
+                if ordered:
+                    timers[name]['p50_ms'] = round(_percentile(ordered, 0.5) * 1000, 3)
+                    timers[name]['p95_ms'] = round(_percentile(ordered, 0.95) * 1000, 3)
+                timer['samples'] = []
+            snapshot = {
+                'time': round(now, 3),
+                'uptime_s': round(now - self.started, 1),
+                'counters': dict(self._counters),
+                'rates': rates,
+                'gauges': dict(self._gauges),
+                'timers': timers,
+            }
+            self._last_counters = dict(self._counters)
+            self._last_snapshot = now
+        return snapshot
+
+
+metrics = Metrics()
+
+
+def prometheus_text(snapshot, prefix='irstats_'):
+    """ A snapshot in the Prometheus text exposition format """
+    clean = lambda name: prefix + name.replace('.', '_').replace('-', '_')
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append('# TYPE {0}_total counter\n{0}_total {1}'.format(clean(name), value))
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines.append('# TYPE {0} gauge\n{0} {1}'.format(clean(name), value))
+    for name, timer in sorted(snapshot['timers'].items()):
+        lines.append('# TYPE {0}_seconds summary'.format(clean(name)))
+        for quantile, key in (('0.5', 'p50_ms'), ('0.95', 'p95_ms')):
+            if key in timer:
+                lines.append('{}_seconds{{quantile="{}"}} {}'.format(clean(name), quantile, round(timer[key] / 1000.0, 6)))
+        lines.append('{}_seconds_sum {}'.format(clean(name), timer['total_s']))
+        lines.append('{}_seconds_count {}'.format(clean(name), timer['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def summary_line(snapshot):
+    """ A one line digest of a snapshot for the log """
+    parts = ["{}={} ({}/s)".format(name, value, snapshot['rates'].get(name, 0))
+             for name, value in sorted(snapshot['counters'].items())]
+    parts += ["{}={}".format(name, value) for name, value in sorted(snapshot['gauges'].items())]
+    parts += ["{} p50={}ms p95={}ms".format(name, timer.get('p50_ms', '-'), timer.get('p95_ms', '-'))
+              for name, timer in sorted(snapshot['timers'].items())]
+    return "metrics: " + ", ".join(parts)
+
+
+class MetricsExporter(threading.Thread):
+    """ Exports a snapshot of `registry` every `interval` seconds, and once
+        more when stopped
+    """
+
+    def __init__(self, registry=metrics, interval=60.0, path=None, log=None):
+        threading.Thread.__init__(self, name="metrics-exporter")
+        self.daemon = True
+        self.registry = registry
+        self.interval = interval
+        self.path = path
+        self.log = log or logging.getLogger(__name__)
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.export()
+
+    def export(self):
+        snapshot = self.registry.snapshot()
+        self.log.info(summary_line(snapshot))
+        if not self.path:
+            return
+        if self.path.endswith('.prom'):
+            # node_exporter's textfile collector must never see a partial file
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(prometheus_text(snapshot))
+            os.replace(tmp_path, self.path)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(snapshot, sort_keys=True) + '\n')
+
+
+@contextlib.contextmanager
+def profiling(path, profiler='cprofile'):
+    """ Profile the calling thread while the block runs, saving the result
+        to `path`: pstats data for cProfile, an HTML report for pyinstrument
+    """
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path, 'w') as f:
+                f.write(profile.output_html())
+    else:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Turns the payloads returned by the stats site into rows for the
+    db_models tables.
+
+    normalize_results() works on one subsession in the collecting thread.
+    For back-fills, where the payloads come from the cache or a replay and
+    parsing is what keeps the collector busy, NormalizePool runs the same
+    conversion on a pool of processes: payloads go out in batches and come
+    back as tuples of typed column values, ready for WriteBuffer.add_rows().
+"""
+
+import itertools
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from laptimes import parse_laptimes
+from db_models import EventResult
+from metrics import metrics
+
+LAPTIME_FIELDS = ['qualifytime', 'averagelaptime', 'fastestlaptime']
+
+
+def normalize_results(subsessionid, results):
+    """ Split the result rows of one subsession into event_result rows and
+        team rows, with the lap times converted to seconds
+    """
+    drivers = []
+    teams = []
+    # a column at a time, a subsession's few dozen values are below laptimes.ARRAY_MIN_VALUES
+    # so parse_laptimes() takes the scalar parser rather than the NumPy one
+    for laptime_var in LAPTIME_FIELDS:
+        for result, seconds in zip(results, parse_laptimes([result[laptime_var] for result in results])):
+            result[laptime_var] = seconds
+
+    for result in results:
+        result['subsessionid'] = subsessionid
+        # team events list each team as a row with a negative custid
+        if int(result['custid']) < 0:
+            teams.append({'id': result['teamid'], 'name': result['name']})
+        else:
+            drivers.append(result)
+    return drivers, teams
+
+
+RESULT_FIELDS = EventResult._meta.sorted_fields
+RESULT_COLUMNS = [field.name for field in RESULT_FIELDS]
+TEAM_COLUMNS = ['id', 'name']
+
+
+def _typed(field, value):
+    # what the column would hold once SQLite's type affinity had converted it
+    try:
+        return field.db_value(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def result_rows(subsessionid, results):
+    """ normalize_results() as tuples of RESULT_COLUMNS and TEAM_COLUMNS """
+    drivers, teams = normalize_results(subsessionid, results)
+    driver_rows = [tuple(_typed(field, driver.get(field.name)) for field in RESULT_FIELDS) for driver in drivers]
+    team_rows = [(int(team['id']), team['name']) for team in teams]
+    return driver_rows, team_rows
+
+
+def normalize_batch(payloads):
+    """ (subsessionid, results, driver rows, team rows) for each
+        (subsessionid, results) in `payloads`, the unit of work of a
+        NormalizePool process. `results` is just the number of result rows,
+        so the payload itself doesn't have to travel back.
+    """
+    return [(subsessionid, len(results)) + result_rows(subsessionid, results)
+            for subsessionid, results in payloads]
+
+
+class NormalizePool(object):
+    """ Normalizes a stream of (subsessionid, results) payloads on `workers`
+        processes, `batch_size` subsessions per task.
+
+        At most `workers * 2` batches are out at a time, so the stream can
+        be a lazy generator of any length. With one worker (or fewer) no
+        processes are started and everything runs inline.
+    """
+
+    def __init__(self, workers=1, batch_size=50):
+        self.workers = workers
+        self.batch_size = max(1, batch_size)
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def map(self, payloads):
+        """ Yield normalize_batch() rows for every payload, in completion order """
+        if self.workers <= 1:
+            for subsessionid, results in payloads:
+                with metrics.timer('parse.results'):
+                    rows = normalize_batch([(subsessionid, results)])
+                yield rows[0]
+            return
+
+        payloads = iter(payloads)
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.workers * 2:
+                batch = list(itertools.islice(payloads, self.batch_size))
+                if batch:
+                    pending.add(self._pool().submit(normalize_batch, batch))
+                if len(batch) < self.batch_size:
+                    exhausted = True
+            metrics.gauge('pool.normalize.pending', len(pending))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for rows in future.result():
+                    yield rows
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" The outbound request layer between the collector and the stats site.
+
+    ThrottledWebStats wraps an iRWebStats client (or a ReplayWebStats) so
+    that every results_archive, event_results and event_laps_all call
+
+    - takes a token from an AdaptiveRateLimiter shared by all fetch threads,
+    - is retried with exponential backoff and full jitter when it fails with
+      a throttling (429), server (5xx) or connection error,
+    - logs in again first when the client's session has dropped.
+
+    The limiter starts at the configured rate and treats it as a ceiling: a
+    throttled response halves the rate, responses much slower than usual
+    trim it, and every good response wins a little of it back. That keeps
+    the sustained rate just under what the site tolerates, whatever that is
+    at the moment.
+
+    pooled_session() keeps the client's connections alive between requests
+    instead of opening a new one for every request.
+"""
+
+import time
+import socket
+import random
+import threading
+import http.client
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+from metrics import metrics
+
+THROTTLED = (429, 503)
+
+# the connection failed rather than the request, asking again may well work
+TRANSPORT_ERRORS = (ConnectionError, TimeoutError, socket.timeout, http.client.HTTPException)
+if requests is not None:
+    TRANSPORT_ERRORS += (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class AdaptiveRateLimiter(object):
+    """ A token bucket refilled at `rate` tokens a second, holding at most
+        `burst` of them, whose rate adapts to how the site responds. A rate
+        of 0 or None disables the limit (and the adapting).
+    """
+
+    def __init__(self, rate=None, min_rate=0.25, burst=2, increase=0.05, slow_factor=3.0, slow_floor=0.5):
+        self.max_rate = float(rate or 0)
+        self.rate = self.max_rate
+        self.min_rate = min(min_rate, self.max_rate) if self.max_rate else 0
+        self.burst = float(burst)
+        self.increase = increase
+        self.slow_factor = slow_factor
+        self.slow_floor = slow_floor
+        self.latency = None
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.max_rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # a negative balance reserves the next token for this caller
+            self._tokens -= 1
+            delay = max(-self._tokens / self.rate, self._paused_until - now, 0.0)
+        if delay > 0:
+            with metrics.timer('ratelimit.wait'):
+                time.sleep(delay)
+
+    def _set_rate(self, rate):
+        self.rate = max(self.min_rate, min(self.max_rate, rate))
+        metrics.gauge('ratelimit.rate', round(self.rate, 3))
+
+    def success(self, latency):
+        """ A request was answered in `latency` seconds """
+        if not self.max_rate:
+            return
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            # anything under slow_floor seconds is quick, however much quicker the average is
+            slow = latency > max(self.latency * self.slow_factor, self.slow_floor)
+            # a slow moving average, so one slow answer doesn't become the new normal
+            self.latency = 0.9 * self.latency + 0.1 * latency
+            self._set_rate(self.rate * 0.9 if slow else self.rate + self.increase)
+
+    def throttled(self, retry_after=None):
+        """ The site pushed back, halve the rate and honour any Retry-After """
+        if not self.max_rate:
+            return
+        with self._lock:
+            self._set_rate(self.rate / 2)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def failed(self):
+        """ A server or connection error, back off a little """
+        if not self.max_rate:
+            return
+        with self._lock:
+            self._set_rate(self.rate * 0.75)
+
+
+def status_code(error):
+    """ The HTTP status of the response behind `error`, if it has one """
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def retry_after(error):
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    """ Throttling, server errors and dropped connections. Anything else,
+        from a race with no data to a response that doesn't parse, would
+        only fail the same way again.
+    """
+    status = status_code(error)
+    if status is not None:
+        return status in THROTTLED or status >= 500
+    return isinstance(error, TRANSPORT_ERRORS)
+
+
+class ThrottledWebStats(object):
+    """ Rate limits, retries and re-logs in the calls made through `irw`.
+        Everything else is passed straight through to the client.
+    """
+
+    def __init__(self, irw, limiter, username=None, password=None, retries=3, backoff=1.0, max_backoff=60.0):
+        self.irw = irw
+        self.limiter = limiter
+        self.username = username
+        self.password = password
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._login_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.irw, name)
+
+    def relogin(self):
+        with self._login_lock:
+            # another thread may have already done it while this one waited
+            if not self.irw.logged:
+                metrics.incr('http.relogins')
+                self.irw.login(self.username, self.password, get_info=False)
+
+    def _call(self, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            if not self.irw.logged:
+                self.relogin()
+            self.limiter.wait()
+            start = time.monotonic()
+            try:
+                value = getattr(self.irw, method)(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retries or not (is_retryable(e) or not self.irw.logged):
+                    raise
+                if status_code(e) in THROTTLED:
+                    metrics.incr('http.throttled')
+                    self.limiter.throttled(retry_after(e))
+                else:
+                    self.limiter.failed()
+                attempt += 1
+                metrics.incr('http.retries')
+                # full jitter keeps the threads that failed together from retrying together
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+                continue
+            self.limiter.success(time.monotonic() - start)
+            return value
+
+    def results_archive(self, *args, **kwargs):
+        return self._call('results_archive', *args, **kwargs)
+
+    def event_results(self, *args, **kwargs):
+        return self._call('event_results', *args, **kwargs)
+
+    def event_laps_all(self, *args, **kwargs):
+        return self._call('event_laps_all', *args, **kwargs)
+
+
+def new_session(connections=1):
+    """ A requests Session keeping up to `connections` connections alive """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, connections), max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class SessionRequests(object):
+    """ Stands in for the requests module inside the client, sending its
+        module level requests.get and requests.post through a Session of
+        the calling thread, so no two fetch threads share one
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = new_session()
+        return session
+
+    def get(self, *args, **kwargs):
+        return self.session().get(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.session().post(*args, **kwargs)
+
+
+def pooled_session(irw, connections=4):
+    """ Keep the connections of `irw` alive between requests. A client with
+        a `session` attribute gets a Session of its own, holding up to
+        `connections` connections. ir_webstats_rc has none, it calls
+        requests.get and requests.post on the module, so its module gets a
+        SessionRequests instead: one Session per fetch thread. Returns the
+        Session or the SessionRequests, None if requests isn't available.
+    """
+    if requests is None:
+        return None
+    if hasattr(irw, 'session'):
+        irw.session = new_session(connections)
+        return irw.session
+    import sys
+    client_module = sys.modules.get(type(irw).__module__)
+    current = getattr(client_module, 'requests', None)
+    if isinstance(current, SessionRequests):
+        return current
+    if current is requests:
+        client_module.requests = SessionRequests()
+        return client_module.requests
+    return None
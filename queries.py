@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Read side lookups for the collected results: a driver's race history,
+    the standings of a season, the lap records of a car at a track, the
+    races of a week of a series and a driver's iRating and license history,
+    race by race or downsampled to days or weeks.
+
+    Each query selects only the columns it returns and hands back a tuple of
+    namedtuples rather than model instances, which is most of the cost of an
+    ad hoc peewee query against the 35 columns of event_result.
+
+    Results are kept in an LRU cache. Before every lookup the connection's
+    write watermark (SQLite's data_version, which moves when any other
+    connection commits, and total_changes(), which moves when this one
+    writes) is compared with the last one seen, and the cache is emptied
+    when it has moved, so a flush by the collector is never hidden by it.
+    A lookup that hits the cache costs the watermark check and nothing else.
+"""
+
+import functools
+import itertools
+import threading
+from collections import namedtuple
+
+from db_models import db, Event, EventResult, SeriesResult, RatingHistory
+
+CACHE_SIZE = 1024
+
+DriverRace = namedtuple('DriverRace', [
+    'subsessionid', 'raw_start_time', 'seasonid', 'race_week_num', 'trackid', 'carid', 'carclassid',
+    'startpos', 'finpos', 'inc', 'lapscomp', 'fastestlaptime', 'oldirating', 'newirating', 'pts'])
+
+Standing = namedtuple('Standing', [
+    'custid', 'name', 'starts', 'wins', 'weeks', 'points', 'avg_finish', 'incidents', 'laps'])
+
+TrackRecord = namedtuple('TrackRecord', ['custid', 'name', 'laptime', 'subsessionid', 'raw_start_time'])
+
+SeriesRace = namedtuple('SeriesRace', [
+    'subsessionid', 'start_time', 'carclassid', 'trackid', 'officialsession', 'sizeoffield', 'strengthoffield'])
+
+RatingPoint = namedtuple('RatingPoint', [
+    'raw_start_time', 'subsessionid', 'oldirating', 'newirating',
+    'oldlicenselevel', 'oldlicensesublevel', 'newlicenselevel', 'newlicensesublevel'])
+
+# oldirating is from before the first race of the bucket, newirating and the license from after the last,
+# low and high are the lowest and highest rating the driver came out of a race with
+RatingBucket = namedtuple('RatingBucket', [
+    'start_time', 'races', 'oldirating', 'newirating', 'low', 'high', 'licenselevel', 'licensesublevel'])
+
+DAY = 86400000
+# raw_start_time is in milliseconds, the epoch was a Thursday and weeks start on Monday (UTC)
+INTERVALS = {'day': (DAY, 0), 'week': (7 * DAY, 4 * DAY)}
+
+# the events drive the joins, and the + signs keep SQLite on the event_result primary key,
+# which only spans one subsession, rather than the carclassid index (see aggregates.BATCH_RESULTS)
+SEASON_STANDINGS = '''
+    WITH races AS (SELECT subsessionid, carclassid, race_week_num FROM events WHERE seasonid = ? AND carclassid = ?),
+    results AS (SELECT r.custid, r.name, r.subsessionid, r.finpos, r.pts, r.inc, r.lapscomp, e.race_week_num
+                FROM races e CROSS JOIN event_result r ON r.subsessionid = e.subsessionid AND +r.carclassid = e.carclassid),
+    winners AS (SELECT subsessionid, MIN(finpos) AS finpos FROM results GROUP BY subsessionid)
+    SELECT r.custid, MAX(r.name), COUNT(*), SUM(r.finpos = w.finpos), COUNT(DISTINCT r.race_week_num),
+           SUM(r.pts), AVG(r.finpos), SUM(r.inc), SUM(r.lapscomp)
+    FROM results r JOIN winners w ON w.subsessionid = r.subsessionid
+    GROUP BY r.custid
+    ORDER BY SUM(r.pts) DESC, r.custid'''
+
+# MIN() in SQLite also returns the other bare columns from the row holding the minimum
+TRACK_RECORDS = '''
+    SELECT r.custid, r.name, MIN(r.fastestlaptime), r.subsessionid, e.raw_start_time
+    FROM events e CROSS JOIN event_result r ON r.subsessionid = e.subsessionid AND +r.carclassid = e.carclassid
+    WHERE e.trackid = ? AND +r.carid = ? AND r.fastestlaptime IS NOT NULL
+    GROUP BY r.custid
+    ORDER BY MIN(r.fastestlaptime), r.custid
+    LIMIT ?'''
+
+_caches = []
+_seen = threading.local()
+
+
+def watermark():
+    """ A value which changes whenever the database has been written to """
+    return db.execute_sql('SELECT data_version, total_changes() FROM pragma_data_version').fetchone()
+
+
+def clear_cache():
+    for cache in _caches:
+        cache.cache_clear()
+
+
+def _check_watermark():
+    mark = watermark()
+    # a thread's first lookup can't tell what changed before it, so it starts afresh as well
+    if getattr(_seen, 'mark', None) != mark:
+        clear_cache()
+        _seen.mark = mark
+
+
+def cached(func):
+    """ Put `func` behind the LRU cache. The undecorated function stays
+        available as `func.uncached`.
+    """
+    cache = functools.lru_cache(maxsize=CACHE_SIZE)(func)
+    _caches.append(cache)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _check_watermark()
+        return cache(*args, **kwargs)
+
+    wrapper.uncached = func
+    wrapper.cache_info = cache.cache_info
+    return wrapper
+
+
+@cached
+def driver_history(custid, seasonid=None):
+    """ Every race of a driver, oldest first, optionally just those of one season """
+    query = (EventResult
+             .select(EventResult.subsessionid, Event.raw_start_time, Event.seasonid, Event.race_week_num,
+                     Event.trackid, EventResult.carid, EventResult.carclassid, EventResult.startpos,
+                     EventResult.finpos, EventResult.inc, EventResult.lapscomp, EventResult.fastestlaptime,
+                     EventResult.oldirating, EventResult.newirating, EventResult.pts)
+             .join(Event, on=((Event.subsessionid == EventResult.subsessionid) &
+                              (Event.carclassid == EventResult.carclassid)))
+             .where(EventResult.custid == custid))
+    if seasonid is not None:
+        query = query.where(Event.seasonid == seasonid)
+    return tuple(DriverRace._make(row) for row in query.order_by(Event.raw_start_time).tuples())
+
+
+@cached
+def season_standings(seasonid, carclassid):
+    """ The drivers of one class in a season, most points first """
+    cursor = db.execute_sql(SEASON_STANDINGS, (seasonid, carclassid))
+    return tuple(Standing._make(row) for row in cursor)
+
+
+@cached
+def track_records(trackid, carid, limit=10):
+    """ The `limit` fastest drivers of a car at a track, by their best race lap """
+    cursor = db.execute_sql(TRACK_RECORDS, (trackid, carid, limit))
+    return tuple(TrackRecord._make(row) for row in cursor)
+
+
+@cached
+def series_week(seasonid, race_week_num):
+    """ The races of one week of a season, class by class, in start order """
+    query = (SeriesResult
+             .select(SeriesResult.subsessionid, SeriesResult.start_time, SeriesResult.carclassid,
+                     SeriesResult.trackid, SeriesResult.officialsession, SeriesResult.sizeoffield,
+                     SeriesResult.strengthoffield)
+             .where((SeriesResult.seasonid == seasonid) & (SeriesResult.week_num == race_week_num))
+             .order_by(SeriesResult.start_time, SeriesResult.subsessionid, SeriesResult.carclassid))
+    return tuple(SeriesRace._make(row) for row in query.tuples())
+
+
+def _rating_points(custids, carcategory, start, end):
+    query = (RatingHistory
+             .select(RatingHistory.custid, RatingHistory.raw_start_time, RatingHistory.subsessionid,
+                     RatingHistory.oldirating, RatingHistory.newirating, RatingHistory.oldlicenselevel,
+                     RatingHistory.oldlicensesublevel, RatingHistory.newlicenselevel, RatingHistory.newlicensesublevel)
+             .where((RatingHistory.custid << custids) & (RatingHistory.carcategory == carcategory)))
+    if start is not None:
+        query = query.where(RatingHistory.raw_start_time >= start)
+    if end is not None:
+        query = query.where(RatingHistory.raw_start_time < end)
+    # the primary key order, so SQLite reads the rows in place without sorting them
+    query = query.order_by(RatingHistory.custid, RatingHistory.carcategory, RatingHistory.raw_start_time)
+    for custid, rows in itertools.groupby(query.tuples(), key=lambda row: row[0]):
+        yield custid, [RatingPoint._make(row[1:]) for row in rows]
+
+
+def downsample(points, interval):
+    """ Fold RatingPoints, oldest first, into one RatingBucket per 'day' or 'week' """
+    size, offset = INTERVALS[interval]
+    buckets = []
+    for start_time, races in itertools.groupby(points, key=lambda p: p.raw_start_time - (p.raw_start_time - offset) % size):
+        races = list(races)
+        ratings = [p.newirating for p in races if p.newirating is not None and p.newirating > 0]
+        last = races[-1]
+        buckets.append(RatingBucket(start_time, len(races), races[0].oldirating, last.newirating,
+                                    min(ratings) if ratings else None, max(ratings) if ratings else None,
+                                    last.newlicenselevel, last.newlicensesublevel))
+    return tuple(buckets)
+
+
+@cached
+def rating_history(custid, carcategory, start=None, end=None, interval=None):
+    """ A driver's iRating and license in one car category (Event.catid),
+        oldest first: every race from `start` up to `end` (raw_start_time
+        milliseconds, either may be None), or one bucket per 'day' or
+        'week' when `interval` is given
+    """
+    return rating_histories([custid], carcategory, start, end, interval).get(custid, ())
+
+
+def rating_histories(custids, carcategory, start=None, end=None, interval=None):
+    """ rating_history() of many drivers at once, as a dict by custid, in one
+        query per chunk of drivers rather than one per driver. Drivers
+        without races in the range are left out.
+    """
+    if interval is not None and interval not in INTERVALS:
+        raise ValueError("interval must be one of {}".format(", ".join(sorted(INTERVALS))))
+    custids = sorted(set(custids))
+    histories = {}
+    # below SQLite's limit on the number of parameters of a statement
+    for i in range(0, len(custids), 500):
+        for custid, points in _rating_points(custids[i:i + 500], carcategory, start, end):
+            histories[custid] = downsample(points, interval) if interval else tuple(points)
+    return histories
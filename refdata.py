@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Keeps the reference tables (cars, car classes, tracks and series) in step
+    with the listings the iRWebStats client loads when it logs in.
+
+    Each table is read once, compared with the listing in memory, and only
+    the new and changed rows are written back, with one bulk upsert.
+"""
+
+from peewee import CharField
+
+from db_models import db, Car, CarClass, Track, Series
+
+# (model, client attribute holding the listing, {column: key in a listing entry})
+# the primary key column comes first
+REFERENCE_TABLES = [
+    (Car, 'CARS', {
+        'carid': 'id',
+        'abbrevname': 'abbrevname',
+        'name': 'name',
+        'dirpath': 'dirpath',
+    }),
+    (CarClass, 'CARCLASS', {
+        'carclassid': 'id',
+        'name': 'name',
+        'shortname': 'shortname',
+    }),
+    (Track, 'TRACKS', {
+        'trackid': 'id',
+        'name': 'name',
+        'config': 'config',
+        'lowerNameAndConfig': 'lowerNameAndConfig',
+        'catid': 'catid',
+        'freeWithSubscription': 'freeWithSubscription',
+    }),
+    (Series, 'SEASON', {
+        'seasonid': 'seasonid',
+        'seriesid': 'seriesid',
+        'catid': 'catid',
+        'seriesname': 'seriesname',
+        'seriesshortname': 'seriesshortname',
+        'multiclass': 'multiclass',
+        'year': 'year',
+        'quarter': 'quarter',
+        'image': 'image',
+    }),
+]
+
+UPSERT_BATCH = 100
+
+
+def _normalize(field, value):
+    """ The value as it would read back from the database, so it can be compared """
+    if value is None:
+        if field.null:
+            return None
+        # the listings don't always have every key, keep NOT NULL columns happy
+        value = '' if isinstance(field, CharField) else 0
+    return field.python_value(field.db_value(value))
+
+
+def sync_table(model, entries, columns):
+    """ Upsert the listing `entries` into `model`, returning (inserted, updated) """
+    fields = [model._meta.fields[name] for name in columns]
+    existing = dict((row[0], row) for row in model.select(*fields).tuples())
+
+    rows = []
+    inserted = updated = 0
+    for entry in entries:
+        row = tuple(_normalize(field, entry.get(key)) for field, key in zip(fields, columns.values()))
+        current = existing.get(row[0])
+        if current is None:
+            inserted += 1
+        elif current != row:
+            updated += 1
+        else:
+            continue
+        existing[row[0]] = row
+        rows.append(dict(zip(columns, row)))
+
+    if rows:
+        with db.atomic():
+            for start in range(0, len(rows), UPSERT_BATCH):
+                model.insert_many(rows[start:start + UPSERT_BATCH]).on_conflict('REPLACE').execute()
+    return inserted, updated
+
+
+def sync_reference_data(irw):
+    """ Sync every reference table with the client's listings.
+        Yields (table name, inserted, updated) as each table is done.
+    """
+    for model, attribute, columns in REFERENCE_TABLES:
+        listing = getattr(irw, attribute, None) or {}
+        inserted, updated = sync_table(model, listing.values(), columns)
+        yield model._meta.table_name, inserted, updated
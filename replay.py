@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Record and replay of the stats site, so the collection pipeline can be
+    run, profiled and benchmarked without a network or an iRacing account.
+
+    RecordingWebStats wraps a logged in client and writes every
+    results_archive, event_results and event_laps_all response to a directory, along with
+    the car, class, track and season listings. ReplayWebStats stands in for
+    iRWebStats and serves those files back. It can add latency and inject
+    errors to mimic a slow or flaky site.
+"""
+
+import os
+import gzip
+import json
+import time
+import random
+import hashlib
+import threading
+
+LISTINGS = ['CARS', 'CARCLASS', 'TRACKS', 'SEASON']
+LISTINGS_FILE = 'listings.json.gz'
+RECORDED_METHODS = ['results_archive', 'event_results', 'event_laps_all']
+
+
+def call_key(method, args, kwargs):
+    return json.dumps([method, list(args), kwargs], sort_keys=True)
+
+
+def call_path(directory, method, args, kwargs):
+    digest = hashlib.sha1(call_key(method, args, kwargs).encode('utf-8')).hexdigest()
+    return os.path.join(directory, method, digest + '.json.gz')
+
+
+def write_json(path, value):
+    # written under a temporary name first so a reader never sees half a file
+    tmp_path = "{}.{}.tmp".format(path, threading.current_thread().ident)
+    with gzip.open(tmp_path, 'wt') as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    with gzip.open(path, 'rt') as f:
+        return json.load(f)
+
+
+class RecordingWebStats(object):
+    """ Passes calls through to `irw`, saving the responses under `directory` """
+
+    def __init__(self, irw, directory):
+        self.irw = irw
+        self.directory = directory
+        for method in RECORDED_METHODS:
+            os.makedirs(os.path.join(directory, method), exist_ok=True)
+        listings = dict((name, getattr(irw, name, None) or {}) for name in LISTINGS)
+        write_json(os.path.join(directory, LISTINGS_FILE), listings)
+
+    def __getattr__(self, name):
+        return getattr(self.irw, name)
+
+    def _record(self, method, *args, **kwargs):
+        value = getattr(self.irw, method)(*args, **kwargs)
+        payload = {'call': call_key(method, args, kwargs), 'response': value}
+        write_json(call_path(self.directory, method, args, kwargs), payload)
+        return value
+
+    def results_archive(self, *args, **kwargs):
+        return self._record('results_archive', *args, **kwargs)
+
+    def event_results(self, *args, **kwargs):
+        return self._record('event_results', *args, **kwargs)
+
+    def event_laps_all(self, *args, **kwargs):
+        return self._record('event_laps_all', *args, **kwargs)
+
+
+class ReplayWebStats(object):
+    """ An offline iRWebStats serving the responses RecordingWebStats saved.
+
+        Every call sleeps for `latency` seconds (plus up to `jitter` more) and
+        raises ConnectionError with probability `error_rate`. Results and lap
+        charts that were never recorded raise IndexError, as the real client
+        does when a race has no results. Archive pages that were never recorded
+        come back empty.
+    """
+
+    def __init__(self, directory, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.directory = directory
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.logged = False
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        listings = {}
+        listings_path = os.path.join(directory, LISTINGS_FILE)
+        if os.path.isfile(listings_path):
+            listings = read_json(listings_path)
+        for name in LISTINGS:
+            setattr(self, name, listings.get(name, {}))
+
+    def login(self, username=None, password=None, get_info=True):
+        self.logged = True
+        return True
+
+    def _simulate(self, method):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + self._random.random() * self.jitter
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise ConnectionError("injected error in replayed {} call".format(method))
+
+    def load(self, method, args, kwargs):
+        """ The recorded response of a call, or None if it wasn't recorded """
+        path = call_path(self.directory, method, args, kwargs)
+        if not os.path.isfile(path):
+            return None
+        return read_json(path)['response']
+
+    def results_archive(self, *args, **kwargs):
+        self._simulate('results_archive')
+        response = self.load('results_archive', args, kwargs)
+        if response is None:
+            return [], 0
+        return response
+
+    def event_results(self, *args, **kwargs):
+        self._simulate('event_results')
+        response = self.load('event_results', args, kwargs)
+        if response is None:
+            raise IndexError("no recorded results for {}".format(args))
+        return response
+
+    def event_laps_all(self, *args, **kwargs):
+        self._simulate('event_laps_all')
+        response = self.load('event_laps_all', args, kwargs)
+        if response is None:
+            raise IndexError("no recorded lap chart for {}".format(args))
+        return response
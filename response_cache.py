@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" An on-disk cache for the responses of the iRWebStats client.
+
+    Responses are stored as zlib compressed JSON in a SQLite file of their
+    own, keyed on the method name and its arguments. Results of a finished
+    subsession never change, so they are kept until evicted. Archive pages
+    of the current season do change and expire after a short TTL. Once the
+    file grows past its size limit, the least recently used responses are
+    evicted.
+"""
+
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+from crawl import current_season
+
+MISSING = object()
+
+# eviction frees a little more than strictly needed so it doesn't run on every put
+EVICT_TO = 0.9
+
+
+class ResponseCache(object):
+    """ A size bounded, thread safe LRU store of JSON serialisable values """
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode = wal')
+        self._conn.execute('PRAGMA synchronous = normal')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, payload BLOB NOT NULL, size INTEGER NOT NULL, '
+            'expires REAL, last_used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key):
+        """ The cached value for `key`, or MISSING if there is none or it expired """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT payload, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return MISSING
+            self._conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, key, value, ttl=None):
+        """ Store `value`, for `ttl` seconds or until evicted when ttl is None """
+        payload = zlib.compress(json.dumps(value).encode('utf-8'))
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                               (key, sqlite3.Binary(payload), len(payload), expires, now))
+            self.total_bytes += len(payload) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        target = self.max_bytes * EVICT_TO
+        victims = []
+        for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY last_used'):
+            if self.total_bytes <= target:
+                break
+            victims.append((key,))
+            self.total_bytes -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', victims)
+        self.evictions += len(victims)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'bytes': self.total_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedWebStats(object):
+    """ Wraps an iRWebStats client so results_archive, event_results and
+        event_laps_all are answered from a ResponseCache when possible. Everything else is
+        passed straight through to the client.
+    """
+
+    def __init__(self, irw, cache, current_season_ttl=3600):
+        self.irw = irw
+        self.cache = cache
+        self.current_season_ttl = current_season_ttl
+
+    def __getattr__(self, name):
+        return getattr(self.irw, name)
+
+    def _cached(self, ttl, method, *args, **kwargs):
+        key = json.dumps([method, args, kwargs], sort_keys=True)
+        value = self.cache.get(key)
+        if value is MISSING:
+            value = getattr(self.irw, method)(*args, **kwargs)
+            self.cache.put(key, value, ttl)
+        return value
+
+    def event_results(self, *args, **kwargs):
+        return self._cached(None, 'event_results', *args, **kwargs)
+
+    def event_laps_all(self, *args, **kwargs):
+        return self._cached(None, 'event_laps_all', *args, **kwargs)
+
+    def results_archive(self, *args, **kwargs):
+        ttl = None
+        season = kwargs.get('season')
+        # pages of the running season change as races finish
+        if season is None or (int(season[0]), int(season[1])) >= current_season():
+            ttl = self.current_season_ttl
+        return self._cached(ttl, 'results_archive', *args, **kwargs)
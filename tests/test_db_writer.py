@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" What WriteBuffer does with rows the database won't take """
+
+import sqlite3
+import logging
+
+import pytest
+
+import db_models
+from db_models import init_db, Team, CollectedSubsession
+from db_writer import WriteBuffer
+
+
+@pytest.fixture
+def database(tmp_path):
+    init_db(str(tmp_path / 'writer.sqlite3'))
+    yield db_models.db
+    db_models.db.close()
+
+
+def test_rejected_row_is_logged_and_the_rest_written(database, caplog, capsys):
+    writer = WriteBuffer()
+    # REPLACE can't fill in the missing name, so the second team breaks its NOT NULL constraint
+    writer.add_rows(Team, ['id', 'name'], [(1, 'one'), (2, None), (3, 'three')], on_conflict='REPLACE')
+    writer.add(CollectedSubsession, {'subsessionid': 5, 'results': 2})
+    with caplog.at_level(logging.WARNING, logger='db_writer'):
+        writer.flush()
+    assert [t.id for t in Team.select().order_by(Team.id)] == [1, 3]
+    assert CollectedSubsession.select().count() == 1
+    assert 'teams' in caplog.text
+    assert capsys.readouterr().out == ''
+
+
+def test_other_errors_roll_the_flush_back(database):
+    writer = WriteBuffer()
+    writer.add(CollectedSubsession, {'subsessionid': 5, 'results': 2})
+    writer.add_rows(Team, ['id', 'name'], [(1, 'one')])
+    database.execute_sql('DROP TABLE teams')
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    # the ledger row went with the rest, so the subsession is fetched again
+    assert CollectedSubsession.select().count() == 0
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Incremental Parquet/Arrow exports with export.export() """
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from peewee import AutoField, IntegerField
+
+import db_models
+from db_models import init_db, Event, EventResult, CollectedSubsession
+from export import export, exported_subsessionids
+
+
+def row(model, **values):
+    """ A row for `model` with a zero or an empty string for every column not given """
+    for field in model._meta.sorted_fields:
+        if not isinstance(field, AutoField):
+            values.setdefault(field.name, 0 if isinstance(field, IntegerField) else '')
+    return values
+
+
+def add_race(subsessionid, drivers):
+    Event.insert(row(Event, subsessionid=subsessionid, carclassid=1, season_year=2019, season_quarter=2)).execute()
+    for custid in range(1, drivers + 1):
+        EventResult.insert(row(EventResult, subsessionid=subsessionid, custid=custid, carclassid=1)).execute()
+    CollectedSubsession.create(subsessionid=subsessionid, results=drivers)
+
+
+@pytest.fixture
+def database(tmp_path):
+    init_db(str(tmp_path / 'export.sqlite3'))
+    yield db_models.db
+    db_models.db.close()
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'arrow'])
+def test_each_subsession_is_exported_once(database, tmp_path, file_format):
+    directory = str(tmp_path / 'export')
+    add_race(1, 3)
+    # collected, but the site had no results for it
+    add_race(2, 0)
+    counts = export(directory, file_format)
+    assert (counts['events'], counts['event_result']) == (2, 3)
+    assert sorted(s for ids in exported_subsessionids(directory) for s in ids) == [1, 2]
+
+    counts = export(directory, file_format)
+    assert (counts['events'], counts['event_result']) == (0, 0)
+
+    add_race(3, 2)
+    counts = export(directory, file_format)
+    assert (counts['events'], counts['event_result']) == (1, 2)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" The states a job goes through in job_queue.JobQueue """
+
+import pytest
+
+import db_models
+import job_queue
+from db_models import init_db, Event, CollectionJob
+from job_queue import JobQueue, SUBSESSION, PENDING, IN_FLIGHT, DONE, FAILED
+
+
+class Clock(object):
+    """ Stands in for the time module, only moving when told to """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(job_queue, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def jobs(tmp_path, clock):
+    init_db(str(tmp_path / 'jobs.sqlite3'))
+    yield JobQueue(max_attempts=3, backoff=30.0)
+    db_models.db.close()
+
+
+def state(key):
+    return CollectionJob.get(kind=SUBSESSION, key=str(key)).state
+
+
+def event_row(subsessionid, carclassid):
+    row = dict((field.name, 0) for field in Event._meta.sorted_fields if field.name != 'id')
+    row.update(subsessionid=subsessionid, carclassid=carclassid)
+    return row
+
+
+def test_claim_then_done(jobs):
+    jobs.add(SUBSESSION, [3, 1, 2])
+    assert jobs.claim(SUBSESSION, limit=2) == ['3', '1']
+    assert (state(3), state(1), state(2)) == (IN_FLIGHT, IN_FLIGHT, PENDING)
+    # jobs in flight aren't handed out twice
+    assert jobs.claim(SUBSESSION) == ['2']
+    assert jobs.claim(SUBSESSION) == []
+    jobs.done(SUBSESSION, [3, 1, 2])
+    assert jobs.counts(SUBSESSION) == {DONE: 3}
+
+
+def test_failed_jobs_back_off(jobs, clock):
+    jobs.add(SUBSESSION, [1])
+    jobs.claim(SUBSESSION)
+    jobs.failed(SUBSESSION, 1, IOError("timed out"))
+    job = CollectionJob.get(key='1')
+    assert (job.state, job.attempts, job.last_error) == (FAILED, 1, "OSError: timed out")
+    assert jobs.claim(SUBSESSION) == []
+    assert jobs.next_retry(SUBSESSION) == 30.0
+
+    clock.now += 30.0
+    assert jobs.next_retry(SUBSESSION) == 0.0
+    assert jobs.claim(SUBSESSION) == ['1']
+    # the backoff doubles with every attempt
+    jobs.failed(SUBSESSION, 1, IOError("timed out"))
+    assert jobs.next_retry(SUBSESSION) == 60.0
+
+    clock.now += 60.0
+    jobs.claim(SUBSESSION)
+    jobs.failed(SUBSESSION, 1, IOError("timed out"))
+    # out of attempts, there is nothing left to wait for
+    clock.now += 3600.0
+    assert jobs.claim(SUBSESSION) == []
+    assert jobs.next_retry(SUBSESSION) is None
+
+
+def test_recover_after_a_crash(jobs):
+    jobs.add(SUBSESSION, [1, 2, 3, 4])
+    jobs.claim(SUBSESSION)
+    jobs.done(SUBSESSION, [1])
+    for _ in range(3):
+        jobs.failed(SUBSESSION, 2, ValueError("bad page"))
+    # 3 and 4 were in flight when the run died
+    assert jobs.recover() == 3
+    assert (state(1), state(2), state(3), state(4)) == (DONE, PENDING, PENDING, PENDING)
+    assert CollectionJob.get(key='2').attempts == 0
+    assert jobs.claim(SUBSESSION) == ['2', '3', '4']
+
+
+def test_add_from_skips_jobs_already_queued(jobs):
+    jobs.add(SUBSESSION, [5])
+    jobs.claim(SUBSESSION)
+    # a race with two classes has two events rows
+    for subsessionid, carclassid in [(5, 1), (6, 1), (6, 2), (7, 1)]:
+        Event.insert(event_row(subsessionid, carclassid)).execute()
+    jobs.add_from(SUBSESSION, Event.select(Event.subsessionid.alias('key')))
+    jobs.add_from(SUBSESSION, Event.select(Event.subsessionid.alias('key')))
+    assert sorted(key for key, in CollectionJob.select(CollectionJob.key).tuples()) == ['5', '6', '7']
+    # the job already in flight is left as it was
+    assert (state(5), state(6), state(7)) == (IN_FLIGHT, PENDING, PENDING)
+    jobs.add(SUBSESSION, [7, 8])
+    assert jobs.counts(SUBSESSION) == {IN_FLIGHT: 1, PENDING: 3}
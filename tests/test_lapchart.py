@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" The NumPy and plain Python lap chart decoders give the same rows """
+
+import random
+
+import pytest
+
+import lapchart
+from lapchart import LAP_FLAGS, lap_columns, decode_laps
+
+SUBSESSIONID = 31000001
+FLAGS = [0, 0, 0, 0, 2, 2 | 4, 4, 8, 32, 32 | 64, 128, 2048, 4 | 32 | 128]
+
+
+def lap_chart(seed, drivers=12, laps=25, missing=0.1):
+    """ An event_laps_all payload, shuffled, with some laps missing """
+    rnd = random.Random(seed)
+    rows = []
+    for custid in rnd.sample(range(1000, 90000), drivers):
+        sestime = 0
+        for lapnum in range(laps + 1):
+            sestime += 0 if lapnum == 0 else rnd.randint(850000, 990000)
+            if lapnum and rnd.random() < missing:
+                continue
+            flags = rnd.choice(FLAGS)
+            rows.append({'custid': custid, 'lapnum': lapnum, 'sesTime': sestime, 'flags': flags})
+    rnd.shuffle(rows)
+    return {'details': {'subsessionid': SUBSESSIONID}, 'lapdata': rows}
+
+
+def both(payload):
+    columns = lap_columns(payload)
+    return lapchart._decode_numpy(SUBSESSIONID, *columns), lapchart._decode_python(SUBSESSIONID, *columns)
+
+
+@pytest.fixture(autouse=True)
+def numpy():
+    if lapchart.np is None:
+        pytest.skip("needs numpy")
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_decoders_agree(seed):
+    numpy_rows, python_rows = both(lap_chart(seed))
+    assert numpy_rows == python_rows
+
+
+def test_missing_laps_have_no_time():
+    payload = {'lapdata': [
+        {'custid': 1, 'lapnum': 0, 'sesTime': 0, 'flags': 0},
+        {'custid': 1, 'lapnum': 1, 'sesTime': 900000, 'flags': 2},
+        # lap 2 is missing, lap 3 can't be timed
+        {'custid': 1, 'lapnum': 3, 'sesTime': 2800000, 'flags': 0},
+        {'custid': 1, 'lapnum': 4, 'sesTime': 3700000, 'flags': 2 | 4},
+        # a driver who only made the start
+        {'custid': 2, 'lapnum': 0, 'sesTime': 0, 'flags': 2048},
+    ]}
+    (laps, summaries), python = both(payload)
+    assert (laps, summaries) == python
+    assert [row[3] for row in laps] == [None, 900000, None, 900000, None]
+    flags = dict(zip([LAP_FLAGS[bit] for bit in sorted(LAP_FLAGS)], summaries[0][4:]))
+    assert summaries[0][:4] == (SUBSESSIONID, 1, 4, 900000)
+    assert (flags['clean_laps'], flags['pitted'], flags['off_tracks']) == (2, 2, 1)
+    assert summaries[1][:4] == (SUBSESSIONID, 2, 1, None)
+
+
+def test_other_spellings_and_bad_times():
+    payload = {'lapData': [
+        {'groupid': -7, 'lap_num': 0, 'ses_time': 0, 'flags': None},
+        {'groupid': -7, 'lap_num': 1, 'ses_time': 500000, 'flags': 2},
+        # a session time going backwards isn't a lap time
+        {'groupid': -7, 'lap_num': 2, 'ses_time': 400000, 'flags': 0},
+        {'groupid': -7, 'lap_num': 3, 'flags': 0},
+    ]}
+    numpy_rows, python_rows = both(payload)
+    assert numpy_rows == python_rows
+    assert [row[3] for row in numpy_rows[0]] == [None, 500000, None, None]
+
+
+def test_empty_chart():
+    assert decode_laps(SUBSESSIONID, {'lapdata': []}) == ([], [])
+    assert decode_laps(SUBSESSIONID, {'lapData': None}) == ([], [])
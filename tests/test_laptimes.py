@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" The scalar and NumPy lap time parsers agree on every kind of value """
+
+import pytest
+
+from laptimes import np, parse_laptime, parse_laptimes, laptime_array, ARRAY_MIN_VALUES
+
+CASES = [
+    # no time
+    (None, None),
+    ('', None),
+    ('-', None),
+    ('00.000', None),
+    ('0:00.000', None),
+    # SS.fff and M:SS.fff
+    ('59.999', 59.999),
+    ('1:23.456', 83.456),
+    ('12:00.5', 720.5),
+    ('83', 83.0),
+    # H:MM:SS.fff
+    ('1:02:03.456', 3723.456),
+    # negative
+    ('-1.250', None),
+    ('-1:23.456', None),
+    (-2.5, None),
+    # not a time
+    ('abc', None),
+    ('1:2x.000', None),
+    ('1.2.3', None),
+    ('1:', None),
+    (':23.4', None),
+    # already numbers
+    (95.25, 95.25),
+    (90, 90.0),
+]
+
+
+@pytest.mark.parametrize('value, expected', CASES)
+def test_parse_laptime(value, expected):
+    assert parse_laptime(value) == expected
+
+
+@pytest.mark.skipif(np is None, reason="needs numpy")
+@pytest.mark.parametrize('value, expected', CASES)
+def test_laptime_array_agrees(value, expected):
+    t = laptime_array([value])[0]
+    assert (None if t != t else t) == expected
+
+
+@pytest.mark.parametrize('length', [len(CASES), ARRAY_MIN_VALUES * 2])
+def test_parse_laptimes_on_either_side_of_the_cutoff(length):
+    values = [CASES[i % len(CASES)][0] for i in range(length)]
+    assert parse_laptimes(values) == [parse_laptime(value) for value in values]
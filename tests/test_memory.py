@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" The collection pipeline runs in constant memory, see benchmarks/bench_memory.py """
+
+import pytest
+
+# the collector can't be imported without the stats site client
+pytest.importorskip('ir_webstats_rc')
+
+import bench_memory
+
+
+def test_peak_memory_does_not_grow_with_subsessions():
+    runs = [bench_memory.run(size, 20, 60) for size in (300, 1500)]
+    assert runs[-1]['results'] > runs[0]['results']
+    assert bench_memory.growth(runs) <= bench_memory.TOLERANCE, runs
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Upgrading databases written by older versions through migrate() """
+
+from peewee import SqliteDatabase, AutoField, IntegerField
+
+import db_models
+# db itself isn't imported, pytest looking at its attributes would open the default database
+from db_models import (init_db, schema_version, SCHEMA_VERSION, SeriesResult, Team, Event, EventResult,
+                       CollectedSubsession, Car, CarClass, Track, Series, RatingHistory)
+
+# the tables of the original version, which had no indexes and no user_version
+BASELINE_MODELS = [SeriesResult, Team, Event, EventResult, Car, CarClass, Track, Series]
+
+SCHEMA = "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL ORDER BY name"
+
+
+def row(model, **values):
+    """ A row for `model` with a zero or an empty string for every column not given """
+    for field in model._meta.sorted_fields:
+        if not isinstance(field, AutoField):
+            values.setdefault(field.name, 0 if isinstance(field, IntegerField) else '')
+    return values
+
+
+def baseline_database(path):
+    # initialize() rather than init_db(), which would migrate it straight away
+    database = SqliteDatabase(path)
+    db_models.db.initialize(database)
+    for model in BASELINE_MODELS:
+        model._schema.create_table()
+    event = row(Event, subsessionid=5, carclassid=1, seasonid=2, catid=2, raw_start_time=1546300800000)
+    # the original insert ignored conflicts, but there was no key to conflict with, so every run added the events again
+    Event.insert(event).on_conflict('IGNORE').execute()
+    Event.insert(event).on_conflict('IGNORE').execute()
+    EventResult.insert(row(EventResult, subsessionid=5, custid=1, carclassid=1, finpos=1,
+                           oldirating=1500, newirating=1520)).execute()
+    database.close()
+
+
+def test_upgrade_baseline_with_duplicate_events(tmp_path):
+    path = str(tmp_path / 'baseline.sqlite3')
+    baseline_database(path)
+    try:
+        init_db(path)
+        assert schema_version() == SCHEMA_VERSION
+        assert Event.select().count() == 1
+        assert CollectedSubsession.select().count() == 1
+        assert SeriesResult.get().strengthoffield == 1500
+        assert RatingHistory.get().newirating == 1520
+    finally:
+        db_models.db.close()
+
+
+def test_upgraded_schema_matches_new_database(tmp_path):
+    baseline_database(str(tmp_path / 'baseline.sqlite3'))
+    try:
+        init_db(str(tmp_path / 'baseline.sqlite3'))
+        upgraded = db_models.db.execute_sql(SCHEMA).fetchall()
+        init_db(str(tmp_path / 'new.sqlite3'))
+        assert db_models.db.execute_sql(SCHEMA).fetchall() == upgraded
+    finally:
+        db_models.db.close()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" The rate limiting and retry decisions of outbound.py """
+
+import json
+import socket
+import threading
+import http.client
+
+import pytest
+
+import outbound
+from outbound import AdaptiveRateLimiter, ThrottledWebStats, is_retryable
+
+
+class Clock(object):
+    """ Stands in for the time module, sleeping only moves it on """
+
+    def __init__(self):
+        self.now = 100.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(outbound, 'time', clock)
+    return clock
+
+
+class Response(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code, headers=None):
+        Exception.__init__(self, status_code)
+        self.response = Response(status_code, headers)
+
+
+def test_burst_then_rate(clock):
+    limiter = AdaptiveRateLimiter(rate=2.0, burst=2)
+    limiter.wait()
+    limiter.wait()
+    assert clock.slept == 0.0
+    for _ in range(8):
+        limiter.wait()
+    # 8 requests past the burst at 2 a second
+    assert clock.slept == pytest.approx(4.0)
+
+
+def test_idle_time_only_refills_the_burst(clock):
+    limiter = AdaptiveRateLimiter(rate=2.0, burst=2)
+    clock.now += 3600.0
+    for _ in range(3):
+        limiter.wait()
+    assert clock.slept == pytest.approx(0.5)
+
+
+def test_no_rate_is_no_limit(clock):
+    limiter = AdaptiveRateLimiter(rate=0)
+    for _ in range(100):
+        limiter.wait()
+    limiter.throttled(retry_after=30)
+    assert clock.slept == 0.0
+
+
+def test_throttling_halves_the_rate_and_honours_retry_after(clock):
+    limiter = AdaptiveRateLimiter(rate=4.0, burst=1)
+    limiter.throttled(retry_after=10.0)
+    assert limiter.rate == 2.0
+    limiter.wait()
+    assert clock.slept == pytest.approx(10.0)
+    # never below min_rate
+    for _ in range(10):
+        limiter.throttled()
+    assert limiter.rate == 0.25
+
+
+def test_rate_recovers_up_to_the_ceiling(clock):
+    limiter = AdaptiveRateLimiter(rate=4.0, increase=0.5)
+    limiter.failed()
+    assert limiter.rate == 3.0
+    limiter.success(0.1)
+    assert limiter.rate == 3.5
+    for _ in range(5):
+        limiter.success(0.1)
+    assert limiter.rate == 4.0
+
+
+def test_slow_answers_trim_the_rate(clock):
+    limiter = AdaptiveRateLimiter(rate=4.0)
+    limiter.success(0.2)
+    # three times the usual latency and over slow_floor
+    limiter.success(0.7)
+    assert limiter.rate == pytest.approx(3.6)
+    # slower than usual, but still quick
+    limiter.latency = 0.05
+    limiter.success(0.4)
+    assert limiter.rate == pytest.approx(3.65)
+
+
+@pytest.mark.parametrize('error', [
+    HTTPError(429), HTTPError(500), HTTPError(502), HTTPError(503),
+    ConnectionResetError(), ConnectionError("injected"), TimeoutError(), socket.timeout(),
+    http.client.RemoteDisconnected(), http.client.IncompleteRead(b''),
+])
+def test_retryable(error):
+    assert is_retryable(error)
+
+
+@pytest.mark.parametrize('error', [
+    HTTPError(400), HTTPError(403), HTTPError(404),
+    # the race has no results, or a response that doesn't parse
+    IndexError(), KeyError('rows'), ValueError("bad value"), json.JSONDecodeError("bad", "<html>", 0),
+    TypeError(), FileNotFoundError(),
+])
+def test_not_retryable(error):
+    assert not is_retryable(error)
+
+
+class FlakyClient(object):
+    """ Raises each of `errors` in turn, then answers """
+
+    logged = True
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def event_results(self, subsessionid):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'subsessionid': subsessionid}, []
+
+
+def test_dropped_connections_are_retried(clock):
+    client = FlakyClient(ConnectionError(), HTTPError(503, {'Retry-After': '5'}))
+    irw = ThrottledWebStats(client, AdaptiveRateLimiter(rate=0), retries=3)
+    assert irw.event_results(7) == ({'subsessionid': 7}, [])
+    assert client.calls == 3
+
+
+def test_parse_errors_are_not_retried(clock):
+    client = FlakyClient(ValueError("no JSON in the response"))
+    irw = ThrottledWebStats(client, AdaptiveRateLimiter(rate=0), retries=3)
+    with pytest.raises(ValueError):
+        irw.event_results(7)
+    assert client.calls == 1
+
+
+def test_session_per_thread():
+    pytest.importorskip('requests')
+    proxy = outbound.SessionRequests()
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(proxy.session()))
+    thread.start()
+    thread.join()
+    assert proxy.session() is proxy.session()
+    assert sessions[0] is not proxy.session()
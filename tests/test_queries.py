@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" The query cache of queries.py is emptied by every write, and only then """
+
+import sqlite3
+
+import pytest
+
+import db_models
+import queries
+from db_models import init_db, Event, EventResult
+from db_writer import WriteBuffer
+
+SEASONID, CARCLASSID = 2402, 74
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'queries.sqlite3')
+    init_db(path)
+    # the cache is per process, a new database starts with an empty one
+    queries.clear_cache()
+    writer = WriteBuffer()
+    for subsessionid in (1, 2):
+        writer.add(Event, race(subsessionid))
+        writer.add(EventResult, result(subsessionid, 100, finpos=0, pts=50))
+        writer.add(EventResult, result(subsessionid, 200, finpos=1, pts=40))
+    writer.flush()
+    yield path
+    db_models.db.close()
+
+
+def row(model, **values):
+    """ A row for `model` with a zero for every column not given """
+    for field in model._meta.sorted_fields:
+        if field.name != 'id':
+            values.setdefault(field.name, 0)
+    return values
+
+
+def race(subsessionid):
+    return row(Event, subsessionid=subsessionid, seasonid=SEASONID, carclassid=CARCLASSID, raw_start_time=subsessionid)
+
+
+def result(subsessionid, custid, **values):
+    return row(EventResult, subsessionid=subsessionid, custid=custid, carclassid=CARCLASSID, **values)
+
+
+def points(standings):
+    return [(s.custid, s.points) for s in standings]
+
+
+def test_repeated_lookups_are_hits(database):
+    assert points(queries.season_standings(SEASONID, CARCLASSID)) == [(100, 100), (200, 80)]
+    assert len(queries.driver_history(200)) == 2
+    hits = queries.season_standings.cache_info().hits
+    queries.season_standings(SEASONID, CARCLASSID)
+    queries.season_standings(SEASONID, CARCLASSID)
+    assert queries.season_standings.cache_info().hits == hits + 2
+    queries.driver_history(200)
+    assert queries.driver_history.cache_info().hits == 1
+
+
+def test_a_flush_empties_the_cache(database):
+    queries.season_standings(SEASONID, CARCLASSID)
+    queries.driver_history(200)
+    writer = WriteBuffer()
+    writer.add(Event, race(3))
+    writer.add(EventResult, result(3, 200, finpos=0, pts=60))
+    # nothing written yet
+    assert points(queries.season_standings(SEASONID, CARCLASSID)) == [(100, 100), (200, 80)]
+    writer.flush()
+    assert points(queries.season_standings(SEASONID, CARCLASSID)) == [(200, 140), (100, 100)]
+    assert len(queries.driver_history(200)) == 3
+
+
+def test_a_commit_by_another_connection_empties_the_cache(database):
+    queries.driver_history(100)
+    other = sqlite3.connect(database)
+    other.execute("UPDATE event_result SET finpos = 5 WHERE custid = 100 AND subsessionid = 1")
+    other.commit()
+    other.close()
+    assert [race.finpos for race in queries.driver_history(100)] == [5, 0]
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Expiry, eviction and the counters of response_cache.ResponseCache """
+
+import random
+
+import pytest
+
+# crawl, which knows the current season, can't be imported without the stats site client
+pytest.importorskip('ir_webstats_rc')
+
+import response_cache
+from response_cache import ResponseCache, CachedWebStats, MISSING
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'))
+    yield cache
+    cache.close()
+
+
+def payload(seed):
+    # random digits, so every payload compresses to about the same size
+    rnd = random.Random(seed)
+    return ''.join(rnd.choice('0123456789abcdef') for _ in range(4000))
+
+
+def test_hits_and_misses(cache):
+    assert cache.get('a') is MISSING
+    cache.put('a', {'rows': [1, 2]})
+    assert cache.get('a') == {'rows': [1, 2]}
+    assert cache.get('a') == {'rows': [1, 2]}
+    assert cache.get('b') is MISSING
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 2, 0)
+    assert stats['bytes'] > 0
+
+
+def test_ttl(cache, clock):
+    cache.put('page', [1], ttl=60)
+    cache.put('results', [2])
+    clock.now += 59
+    assert cache.get('page') == [1]
+    clock.now += 2
+    assert cache.get('page') is MISSING
+    # no ttl, kept until evicted
+    clock.now += 10 ** 6
+    assert cache.get('results') == [2]
+
+
+def test_least_recently_used_are_evicted_first(cache, clock):
+    cache.put('a', payload(1))
+    size = cache.stats()['bytes']
+    # room for three and a half of them
+    cache.max_bytes = int(size * 3.5)
+    for key, seed in [('b', 2), ('c', 3)]:
+        clock.now += 1
+        cache.put(key, payload(seed))
+    clock.now += 1
+    cache.get('a')
+    clock.now += 1
+    cache.put('d', payload(4))
+    assert cache.stats()['evictions'] == 1
+    assert cache.get('b') is MISSING
+    assert [cache.get(key) is MISSING for key in 'acd'] == [False, False, False]
+    assert cache.stats()['bytes'] <= cache.max_bytes
+
+
+def test_replacing_a_value_counts_its_size_once(cache):
+    cache.put('a', payload(1))
+    size = cache.stats()['bytes']
+    cache.put('a', payload(1))
+    assert cache.stats()['bytes'] == size
+    # and the size is read back when the file is opened again
+    reopened = ResponseCache(cache.path)
+    assert reopened.stats()['bytes'] == size
+    reopened.close()
+
+
+class Client(object):
+    def __init__(self):
+        self.calls = 0
+
+    def results_archive(self, season=None, page=1):
+        self.calls += 1
+        return [[page], 1]
+
+    def event_results(self, subsessionid):
+        self.calls += 1
+        return [{'subsessionid': subsessionid}, []]
+
+
+def test_cached_web_stats(cache, clock, monkeypatch):
+    monkeypatch.setattr(response_cache, 'current_season', lambda: (2019, 3))
+    client = Client()
+    irw = CachedWebStats(client, cache, current_season_ttl=60)
+    assert irw.event_results(7) == irw.event_results(7)
+    assert client.calls == 1
+
+    irw.results_archive(season=(2019, 2, 'road'), page=1)
+    irw.results_archive(season=(2019, 3, 'road'), page=1)
+    clock.now += 61
+    # pages of past seasons are final, those of the running one expire
+    irw.results_archive(season=(2019, 2, 'road'), page=1)
+    irw.results_archive(season=(2019, 3, 'road'), page=1)
+    assert client.calls == 4
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" What Worker.save_results leaves in the database at each flush """
+
+import argparse
+import logging
+
+import pytest
+
+import db_models
+from db_models import (init_db, Event, EventResult, CollectedSubsession, AggregatedSubsession, DriverWeekStats,
+                       RatingHistory)
+from normalize import RESULT_COLUMNS, result_rows
+
+# the collector can't be imported without the stats site client
+pytest.importorskip('ir_webstats_rc')
+
+from worker import Worker
+from synthetic import SyntheticWebStats
+
+SUBSESSIONID = 8077000001
+
+
+class App(object):
+    """ Just enough of collect.App for a Worker """
+
+    def __init__(self, flush_rows):
+        self.args = argparse.Namespace(flush_rows=flush_rows, flush_interval=3600.0, workers=1, max_attempts=5,
+                                       retry_backoff=30.0)
+        self.irw = None
+        self.log = logging.getLogger('test')
+
+
+@pytest.fixture
+def database(tmp_path):
+    init_db(str(tmp_path / 'worker.sqlite3'))
+    yield db_models.db
+    db_models.db.close()
+
+
+def counts():
+    return (CollectedSubsession.select().count(), EventResult.select().count(),
+            AggregatedSubsession.select().count(), RatingHistory.select().count())
+
+
+def test_a_subsession_commits_as_a_unit(database):
+    irw = SyntheticWebStats(subsessions=1, min_drivers=30, max_drivers=30)
+    Event.insert(dict((name, value) for name, value in irw.event(SUBSESSIONID, 2019, 2).items()
+                      if name in Event._meta.fields)).execute()
+    results = irw.results(SUBSESSIONID)[1]
+    driver_rows, team_rows = result_rows(SUBSESSIONID, results)
+    # the results and the ledger row alone reach flush_rows, the totals are queued after them
+    worker = Worker(App(flush_rows=len(driver_rows) + 1))
+    worker.save_results(SUBSESSIONID, len(results), driver_rows, team_rows)
+    assert counts() == (1, 30, 1, 30)
+    assert DriverWeekStats.select().count() == 30
+
+
+def test_nothing_is_written_before_the_subsession_is_queued(database):
+    irw = SyntheticWebStats(subsessions=1, min_drivers=30, max_drivers=30)
+    results = irw.results(SUBSESSIONID)[1]
+    driver_rows, team_rows = result_rows(SUBSESSIONID, results)
+    worker = Worker(App(flush_rows=10))
+    worker.writer.add_rows(EventResult, RESULT_COLUMNS, driver_rows)
+    # a crash here loses the rows, but not half a subsession
+    assert counts() == (0, 0, 0, 0)
+    assert worker.writer.pending == 30
+
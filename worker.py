@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" The collection worker: the thread that works through the job queue,
+    fetching archive pages, results and lap charts and writing them to the
+    database. collect.py sets it up and runs it.
+"""
+
+import sys
+import time
+import threading
+import queue as queue
+import contextlib
+
+from db_models import *
+from fetch_pool import FetchPool
+from db_writer import WriteBuffer
+from normalize import NormalizePool, RESULT_COLUMNS, TEAM_COLUMNS
+from refdata import sync_reference_data
+from aggregates import update_aggregates
+from lapchart import LAP_COLUMNS, SUMMARY_COLUMNS, decode_laps
+from crawl import plan_seasons, page_count, archive_query
+from job_queue import JobQueue, ARCHIVE_PAGE, SUBSESSION, LAPCHART, DONE, archive_page_key, split_archive_page_key
+from metrics import metrics, profiling
+
+
+def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_length=70):
+    """Call in a loop to create terminal progress bar """
+    str_format = "{0:." + str(decimals) + "f}"
+    percents = str_format.format(100 * (iteration / float(total)))
+    filled_length = int(round(bar_length * iteration / float(total)))
+    bar = '█' * filled_length + '-' * (bar_length - filled_length)
+
+    sys.stdout.write('\r%s |%s| %s%s %s' % (prefix, bar, percents, '%', suffix)),
+
+    if iteration == total:
+        sys.stdout.write('\n')
+    sys.stdout.flush()
+
+def print_counting(count, prefix='', suffix='', finished=False):
+    """Call in a loop to create terminal count update """
+
+    sys.stdout.write('\r%s %s %s' % (prefix, count, suffix)),
+
+    if finished:
+        sys.stdout.write('\n')
+    sys.stdout.flush()
+
+class ExThread(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.__status_queue = queue.Queue()
+
+    def run_with_exception(self):
+        """This method should be overriden."""
+        raise NotImplementedError
+
+    def run(self):
+        """This method should NOT be overriden."""
+        try:
+            self.run_with_exception()
+        except BaseException:
+            self.__status_queue.put(sys.exc_info())
+        self.__status_queue.put(None)
+
+    def wait_for_exc_info(self):
+        return self.__status_queue.get()
+
+    def join_with_exception(self):
+        ex_info = self.wait_for_exc_info()
+        if ex_info is None:
+            return
+        else:
+            raise ex_info[1]
+
+
+class MyException(Exception):
+    pass
+
+
+class Worker(ExThread):
+    """ A class which contains the worker thread logic
+    """
+
+    def __init__(self, parent):
+        # copy over args from parent to self
+        self.args = parent.args
+
+        # copy over any other values from parent to self
+        self.irw = parent.irw
+        self.log = parent.log
+
+        # all inserts go through one buffer so they are committed in batches
+        self.writer = WriteBuffer(flush_rows=self.args.flush_rows, flush_interval=self.args.flush_interval, log=self.log)
+
+        # result parsing, on --workers processes when there is more than one
+        self.normalizer = NormalizePool(workers=self.args.workers)
+
+        # what still has to be fetched, kept in the database so --resume can carry on
+        self.jobs = JobQueue(max_attempts=self.args.max_attempts, backoff=self.args.retry_backoff)
+
+        ExThread.__init__(self)
+
+    def uncollected_subsessionids(self):
+        """ A query for the subsessions in the events table which have no
+            results stored yet, worked out by the database in one pass
+        """
+        return (Event
+                .select(Event.subsessionid.alias('key'))
+                .join(CollectedSubsession, JOIN.LEFT_OUTER,
+                      on=(CollectedSubsession.subsessionid == Event.subsessionid))
+                .where(CollectedSubsession.subsessionid.is_null())
+                .distinct())
+
+    def save_results(self, subsessionid, results, driver_rows, team_rows):
+        """ Queue the normalized driver and team rows of one subsession for writing """
+        self.writer.add_rows(Team, TEAM_COLUMNS, team_rows, on_conflict='REPLACE')
+        self.writer.add_rows(EventResult, RESULT_COLUMNS, driver_rows)
+        self.writer.add(CollectedSubsession, {'subsessionid': subsessionid, 'results': results}, on_conflict='REPLACE')
+        # the running totals are brought up to date once per flush for all of its subsessions
+        self.writer.defer_batch(update_aggregates, subsessionid)
+        metrics.incr('rows.results', results)
+        self.job_done(SUBSESSION, subsessionid)
+        # only now, so the rows, the ledger entry and the totals of the subsession commit together
+        self.writer.maybe_flush()
+        return results
+
+    def claim_jobs(self, kind):
+        """ Claim a chunk of the due jobs of `kind`, waiting out the backoff of
+            failed ones when nothing else is left. Returns [] once none are
+            left to claim.
+        """
+        while True:
+            keys = self.jobs.claim(kind)
+            metrics.gauge('jobs.{}.claimed'.format(kind), len(keys))
+            if keys:
+                return keys
+            delay = self.jobs.next_retry(kind)
+            if delay is None:
+                return []
+            print("Retrying failed {} jobs in {:.0f} seconds".format(kind, delay))
+            time.sleep(delay)
+
+    def queued_jobs(self, kind):
+        """ Yield the keys of the queued jobs of `kind`, claiming them a chunk
+            at a time as they are consumed, so jobs queued meanwhile are
+            picked up as well
+        """
+        keys = self.claim_jobs(kind)
+        while keys:
+            for key in keys:
+                yield key
+            keys = self.claim_jobs(kind)
+
+    def fetch_archive_page(self, key):
+        season, page = split_archive_page_key(key)
+        return self.irw.results_archive(**archive_query(season, page))
+
+    def fetch_failed(self, kind, key, error):
+        self.log.warning("Fetching %s %s failed: %r", kind, key, error)
+        metrics.incr('jobs.{}.failed'.format(kind))
+        self.jobs.failed(kind, key, error)
+
+    def job_done(self, kind, key):
+        # marked done in the same transaction that stores what was fetched
+        self.writer.defer_batch(self.jobs.done, key, kind)
+        metrics.incr('jobs.{}.done'.format(kind))
+
+    def store_archive_page(self, key, r):
+        """ Queue the events of one results_archive page for writing. The
+            first page of a season queues the jobs for the rest, returns how
+            many it queued.
+        """
+        season, page = split_archive_page_key(key)
+        more_pages = []
+        if page == 1:
+            event_count = r[1]
+            print("\rEvents found for {}: {}".format(season, event_count))
+            self.log.info("Events found for %s: %s", season, event_count)
+            more_pages = [archive_page_key(season, p) for p in range(2, page_count(event_count) + 1)]
+            self.jobs.add(ARCHIVE_PAGE, more_pages)
+        # pages shift as races finish during the crawl, the unique index drops events seen twice
+        for event in r[0]:
+            self.writer.add(Event, event)
+        metrics.incr('rows.events', len(r[0]))
+        self.job_done(ARCHIVE_PAGE, key)
+        self.writer.maybe_flush()
+        return len(more_pages)
+
+    def collect_archive(self):
+        """ Work through the queued results_archive pages, storing their events.
+            The first page of a season tells us how many more pages to queue,
+            and those are claimed as the stream of pages goes on.
+        """
+        counts = self.jobs.counts(ARCHIVE_PAGE)
+        pages_done = counts.get('done', 0)
+        pages_total = sum(counts.values())
+        pool = FetchPool(self.fetch_archive_page, workers=self.args.fetch_workers,
+                         name='results_archive')
+        # a pass ends when nothing is claimable, pages failing or queued at its very end need another
+        while True:
+            fetched = 0
+            for key, future in pool.map(self.queued_jobs(ARCHIVE_PAGE)):
+                fetched += 1
+                try:
+                    r = future.result()
+                except Exception as e:
+                    self.fetch_failed(ARCHIVE_PAGE, key, e)
+                    continue
+                pages_total += self.store_archive_page(key, r)
+                pages_done += 1
+                print_progress(pages_done, pages_total, prefix="Progress: ", suffix="of archive pages collected  ")
+            self.writer.flush()
+            if not fetched:
+                break
+
+    def collect_results(self, subsessionids, total=None, done=0):
+        """ Fetch and store the results of `subsessionids`, which can be a
+            lazy iterable of any length. Returns the number of subsessions
+            processed. `total` and `done` are for the progress bar.
+        """
+        total = total or 1
+        processed = 0
+        result_count = 0
+        # the pool threads only fetch, every database write happens here in the worker thread
+        pool = FetchPool(self.irw.event_results, workers=self.args.fetch_workers,
+                         name='event_results')
+
+        def fetched():
+            nonlocal processed
+            for subsessionid, future in pool.map(subsessionids):
+                processed += 1
+                try:
+                    event_results = future.result()
+                except IndexError:
+                    # no results to be had for this race, don't keep asking
+                    self.job_done(SUBSESSION, subsessionid)
+                    event_results = None
+                except Exception as e:
+                    self.fetch_failed(SUBSESSION, subsessionid, e)
+                    event_results = None
+                if event_results:
+                    yield subsessionid, event_results[1]
+                print_progress(min(done + processed, total), total, prefix="Progress: ", suffix="of results collected  ")
+
+        try:
+            # parsing may happen on other processes, the rows come back here to be written
+            for subsessionid, results, driver_rows, team_rows in self.normalizer.map(fetched()):
+                result_count += self.save_results(subsessionid, results, driver_rows, team_rows)
+        finally:
+            self.writer.flush()
+
+        if processed:
+            print("Race results for {} drivers saved to database".format(result_count))
+            self.log.info("Race results for %s drivers saved to database", result_count)
+        return processed
+
+    def collect_queued_results(self):
+        """ Collect results for queued subsessions until none are left, retrying failures """
+        counts = self.jobs.counts(SUBSESSION)
+        total = sum(counts.values())
+        done = counts.get('done', 0)
+        print("Collecting results for {} races".format(total - done))
+        self.log.info("Collecting results for %s races", total - done)
+        if total == done:
+            return
+        print_progress(done, total, prefix="Progress: ", suffix="of results collected  ")
+        # keys still in flight when the claims run dry may fail and need another pass
+        while True:
+            processed = self.collect_results((int(s) for s in self.queued_jobs(SUBSESSION)), total, done)
+            if not processed:
+                break
+            done = self.jobs.counts(SUBSESSION).get('done', 0)
+
+    def uncollected_lapcharts(self):
+        """ A query for the subsessions with results but no lap chart stored yet """
+        return (CollectedSubsession
+                .select(CollectedSubsession.subsessionid.alias('key'))
+                .join(CollectedLapChart, JOIN.LEFT_OUTER,
+                      on=(CollectedLapChart.subsessionid == CollectedSubsession.subsessionid))
+                .where(CollectedLapChart.subsessionid.is_null()))
+
+    def save_lapchart(self, subsessionid, payload):
+        """ Queue the lap rows and per-driver lap summaries of one subsession
+            for writing. A None payload (no lap chart to be had) just
+            finishes the job.
+        """
+        laps = []
+        if payload:
+            with metrics.timer('parse.laps'):
+                laps, summaries = decode_laps(subsessionid, payload)
+            self.writer.add_rows(Lap, LAP_COLUMNS, laps)
+            self.writer.add_rows(LapSummary, SUMMARY_COLUMNS, summaries, on_conflict='REPLACE')
+            self.writer.add(CollectedLapChart, {'subsessionid': subsessionid, 'laps': len(laps)}, on_conflict='REPLACE')
+            metrics.incr('rows.laps', len(laps))
+        self.job_done(LAPCHART, subsessionid)
+        self.writer.maybe_flush()
+        return len(laps)
+
+    def collect_lapcharts(self):
+        """ Collect the lap chart of every race with results, until none are left """
+        self.jobs.add_from(LAPCHART, self.uncollected_lapcharts())
+        counts = self.jobs.counts(LAPCHART)
+        total = sum(counts.values())
+        done = counts.get('done', 0)
+        print("Collecting lap charts for {} races".format(total - done))
+        self.log.info("Collecting lap charts for %s races", total - done)
+        pool = FetchPool(self.irw.event_laps_all, workers=self.args.fetch_workers,
+                         name='event_laps_all')
+        lap_count = 0
+        while total > done:
+            processed = 0
+            try:
+                for subsessionid, future in pool.map(int(s) for s in self.queued_jobs(LAPCHART)):
+                    processed += 1
+                    try:
+                        payload = future.result()
+                    except IndexError:
+                        payload = None
+                    except Exception as e:
+                        self.fetch_failed(LAPCHART, subsessionid, e)
+                        continue
+                    lap_count += self.save_lapchart(subsessionid, payload)
+                    print_progress(min(done + processed, total), total, prefix="Progress: ", suffix="of lap charts collected  ")
+            finally:
+                self.writer.flush()
+            if not processed:
+                break
+            done = self.jobs.counts(LAPCHART).get('done', 0)
+        print("{} laps saved to database".format(lap_count))
+        self.log.info("%s laps saved to database", lap_count)
+
+    def collect(self):
+        """ Fetch the queued archive pages, then the results of every race they
+            listed, and their lap charts if asked to
+        """
+        # everything is written from this thread
+        with self.bulk_loading():
+            self.collect_archive()
+
+            self.jobs.add_from(SUBSESSION, self.uncollected_subsessionids())
+            self.collect_queued_results()
+
+            if self.args.laps:
+                self.collect_lapcharts()
+        self.normalizer.close()
+
+    def bulk_loading(self):
+        """ bulk_load() with --bulk-load, to be entered on the thread which writes """
+        return bulk_load() if self.args.bulk_load else contextlib.nullcontext()
+
+    def run_with_exception(self):
+        # the profiler only sees this thread, the fetches show up as time spent waiting on the pool
+        if self.args.profile:
+            with profiling(self.args.profile, self.args.profiler):
+                return self.run_collection()
+        return self.run_collection()
+
+    def run_collection(self):
+        thread_name = threading.current_thread().name
+
+        if not self.irw.logged:
+            raise MyException("ERROR: {}".format("Login failed. Please check your credentials."))
+        else:
+            print("Updating service information...")
+            for table, inserted, updated in sync_reference_data(self.irw):
+                print("Updating {}: {} new, {} changed.".format(table, inserted, updated))
+
+            seasons = []
+            self.current_seasons = {}
+            self.current_seasonids = []
+            self.collected_seasons = {}
+            query = Series.select()
+            for res in query:
+                self.collected_seasons[res.seasonid] = res.seriesname
+                if self.args.seasons:
+                    print("seasonid {} = {}".format(res.seasonid, res.seriesname))
+            if self.args.seasons:    
+                return True
+
+            if self.args.resume:
+                # the seasons are those of the run being resumed, whatever --year and --quarter say now
+                recovered = self.jobs.recover()
+                print("Resuming previous run ({} unfinished jobs requeued)".format(recovered))
+                for kind in (ARCHIVE_PAGE, SUBSESSION, LAPCHART):
+                    counts = self.jobs.counts(kind)
+                    pending = sum(counts.values()) - counts.get(DONE, 0)
+                    print("{} {} jobs left".format(pending, kind))
+                    self.log.info("%s %s jobs left", pending, kind)
+            else:
+                seasons = plan_seasons(self.args.year, self.args.quarter, self.args.race_type)
+                print("Seasons to collect: {}".format(", ".join(seasons)))
+                self.log.info("Seasons to collect: %s", ", ".join(seasons))
+                self.jobs.clear()
+                self.jobs.add(ARCHIVE_PAGE, [archive_page_key(season, 1) for season in seasons])
+
+            self.collect()
+
+            for kind in (ARCHIVE_PAGE, SUBSESSION, LAPCHART):
+                failed = self.jobs.counts(kind).get('failed', 0)
+                if failed:
+                    print("{} {} jobs gave up after {} attempts, run again with --resume to retry them".format(failed, kind, self.args.max_attempts))